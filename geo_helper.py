@@ -8,6 +8,8 @@
 #  easting/northing -> Lat+Long (OS GB+IE Only)
 #  OS easting/northing -> OS 6 figure ref
 #
+# The _many variants take and return NumPy arrays, for bulk conversions
+#
 # See http://gagravarr.org/code/ for updates and information
 #
 # GPL
@@ -16,6 +18,11 @@
 
 import math
 
+try:
+	import numpy
+except ImportError:
+	numpy = None # only needed by the _many variants
+
 # For each co-ordinate system we do, what are the A, B and E2 values?
 # List is A, B, E^2 (E^2 calculated after)
 abe_values = {
@@ -483,6 +490,266 @@ def turn_cassini_en_into_latlong(easting,northing,scheme):
 
 	return (lat_dec,long_dec)
 
+##############################################################
+#        Array Versions, for many points at once             #
+##############################################################
+
+def turn_wgs84_into_osgb36_many(lat_dec,long_dec,height):
+	"""As per turn_wgs84_into_osgb36, but for arrays of points"""
+	x,y,z = turn_llh_into_xyz_many(lat_dec,long_dec,height,'wgs84')
+	x,y,z = turn_xyz_into_other_xyz_many(x,y,z,'wgs84','osgb')
+	return turn_xyz_into_llh_many(x,y,z,'osgb')
+
+def turn_osgb36_into_wgs84_many(lat_dec,long_dec,height):
+	"""As per turn_osgb36_into_wgs84, but for arrays of points"""
+	x,y,z = turn_llh_into_xyz_many(lat_dec,long_dec,height,'osgb')
+	x,y,z = turn_xyz_into_other_xyz_many(x,y,z,'osgb','wgs84')
+	return turn_xyz_into_llh_many(x,y,z,'wgs84')
+
+def turn_osgb36_into_eastingnorthing_many(lat_dec,long_dec):
+	"""As per turn_osgb36_into_eastingnorthing, but for arrays of points"""
+	return turn_latlong_into_eastingnorthing_many(lat_dec,long_dec,'osgb')
+
+def turn_eastingnorthing_into_osgb36_many(easting,northing):
+	"""As per turn_eastingnorthing_into_osgb36, but for arrays of points"""
+	return turn_eastingnorthing_into_latlong_many(easting,northing,'osgb')
+
+def turn_llh_into_xyz_many(lat_dec,long_dec,height,system):
+	"""As per turn_llh_into_xyz, but for arrays of points"""
+
+	a = abe_values[system][0]
+	e2 = abe_values[system][2]
+
+	theta = numpy.asarray(lat_dec, dtype=float) / 360.0 * 2.0 * math.pi
+	landa = numpy.asarray(long_dec, dtype=float) / 360.0 * 2.0 * math.pi
+	height = numpy.asarray(height, dtype=float)
+
+	sin_theta = numpy.sin(theta)
+	cos_theta = numpy.cos(theta)
+	v = a / numpy.sqrt( 1.0 - e2 * (sin_theta * sin_theta) )
+	x = (v + height) * cos_theta * numpy.cos(landa)
+	y = (v + height) * cos_theta * numpy.sin(landa)
+	z = ( (1.0 - e2) * v + height ) * sin_theta
+
+	return [x,y,z]
+
+def turn_xyz_into_llh_many(x,y,z,system):
+	"""As per turn_xyz_into_llh, but for arrays of points"""
+
+	a = abe_values[system][0]
+	e2 = abe_values[system][2]
+
+	p = numpy.sqrt(x*x + y*y)
+
+	long = numpy.arctan(y/x)
+	lat_init = numpy.arctan( z / (p * (1.0 - e2)) )
+	sin_init = numpy.sin(lat_init)
+	v = a / numpy.sqrt( 1.0 - e2 * (sin_init * sin_init) )
+	lat = numpy.arctan( (z + e2*v*sin_init) / p )
+
+	height = (p / numpy.cos(lat)) - v # Ignore if a bit out
+
+	# Turn from radians back into degrees
+	long = long / 2 / math.pi * 360
+	lat = lat / 2 / math.pi * 360
+
+	return [lat,long,height]
+
+def turn_xyz_into_other_xyz_many(old_x,old_y,old_z,from_scheme,to_scheme):
+	"""As per turn_xyz_into_other_xyz, but for arrays of points"""
+	# the sums are the same, element by element
+	return turn_xyz_into_other_xyz(old_x,old_y,old_z,from_scheme,to_scheme)
+
+def _meridian_arc_many(theta,theta0,n,b,f0):
+	"""The M series of the Transverse Mercator sums, for arrays of theta"""
+	return b * f0 * ( \
+		(1.0 + n + 5.0/4.0 *n*n + 5.0/4.0 *n*n*n) * (theta-theta0) - \
+		(3.0*n + 3.0*n*n + 21.0/8.0 *n*n*n) *numpy.sin(theta-theta0) *numpy.cos(theta+theta0) + \
+		(15.0/8.0*n*n + 15.0/8.0*n*n*n) *numpy.sin(2.0*(theta-theta0)) *numpy.cos(2.0*(theta+theta0)) - \
+		35.0/24.0*n*n*n *numpy.sin(3.0*(theta-theta0)) *numpy.cos(3.0*(theta+theta0)) \
+	)
+
+def turn_latlong_into_eastingnorthing_many(lat_dec,long_dec,scheme):
+	"""As per turn_latlong_into_eastingnorthing, but for arrays of points"""
+
+	n0, e0, f0, theta0, landa0 = en_values[scheme]
+	a, b, e2 = abe_values[scheme]
+
+	theta = numpy.asarray(lat_dec, dtype=float) /360.0 *2.0*math.pi
+	landa = numpy.asarray(long_dec, dtype=float) /360.0 *2.0*math.pi
+
+	sin_theta = numpy.sin(theta)
+	cos_theta = numpy.cos(theta)
+	tan2 = numpy.tan(theta) ** 2
+	tan4 = tan2 * tan2
+
+	n = (a-b) / (a+b)
+	w = 1 - e2 * sin_theta*sin_theta
+	v = a * f0 * w ** -0.5
+	ro = a * f0 * (1 - e2) * w ** -1.5
+	nu2 = v/ro - 1
+
+	M = _meridian_arc_many(theta,theta0,n,b,f0)
+
+	I = M + n0
+	II = v/2.0 * sin_theta * cos_theta
+	III = v/24.0 * sin_theta * cos_theta**3 * (5.0 - tan2 + 9.0*nu2)
+	IIIa = v/720.0 * sin_theta * cos_theta**5 * ( 61.0 - 58.0 *tan2 + tan4 )
+	IV = v * cos_theta
+	V = v/6.0 * cos_theta**3 * ( v/ro - tan2 )
+	VI = v/120.0 * cos_theta**5 * \
+		( 5.0 - 18.0 *tan2 + tan4 + 14.0*nu2 - 58.0 * tan2*nu2 )
+
+	dl = landa-landa0
+	dl2 = dl * dl
+	northing = I + II*dl2 + III*dl2*dl2 + IIIa*dl2*dl2*dl2
+	easting = e0 + IV*dl + V*dl2*dl + VI*dl2*dl2*dl
+
+	return (easting,northing)
+
+def turn_eastingnorthing_into_latlong_many(easting,northing,scheme):
+	"""As per turn_eastingnorthing_into_latlong, but for arrays of points"""
+
+	n0, e0, f0, theta0, landa0 = en_values[scheme]
+	a, b, e2 = abe_values[scheme]
+
+	easting = numpy.asarray(easting, dtype=float)
+	northing = numpy.asarray(northing, dtype=float)
+
+	n = (a-b) / (a+b)
+
+	# Iterate, 4 times should be enough
+	M = 0
+	theta = theta0
+	for i in range(4):
+		theta = ((northing - n0 - M) / (a * f0)) + theta
+		M = _meridian_arc_many(theta,theta0,n,b,f0)
+
+	# Compute intermediate values
+	sin_theta = numpy.sin(theta)
+	w = 1 - e2 * sin_theta*sin_theta
+	v = a * f0 * w ** -0.5
+	ro = a * f0 * (1 - e2) * w ** -1.5
+	nu2 = v/ro - 1
+	tan_theta = numpy.tan(theta)
+	tantheta2 = tan_theta ** 2
+	sec_theta = 1 / numpy.cos(theta)
+
+	VII = tan_theta / (2 * ro * v)
+	VIII = tan_theta / (24 * ro * v**3) \
+			* (5 + 3 * tantheta2 + nu2 - 9 * tantheta2 * nu2 )
+	IX = tan_theta / (720 * ro * v**5) \
+			* (61 + 90 * tantheta2 + 45 * tantheta2 * tantheta2)
+	X = sec_theta / v
+	XI = sec_theta / (6 * v**3) * (v/ro + 2*tantheta2)
+	XII = sec_theta / (120 * v**5) \
+			* (5 + 28 * tantheta2 + 24 * tantheta2 * tantheta2)
+	XIIa = sec_theta / (5040 * v**7) \
+			* (61 + 662 * tantheta2 + 1320 * tantheta2 * tantheta2 \
+				+ 720 * tantheta2 * tantheta2 * tantheta2)
+
+	de = easting-e0
+	de2 = de * de
+	lat_rad = theta - VII * de2 + VIII * de2*de2 - IX * de2*de2*de2
+	long_rad = landa0 + X * de - XI * de2*de + XII * de2*de2*de \
+				- XIIa * de2*de2*de2*de
+
+	lat = lat_rad / 2.0 / math.pi * 360.0
+	long = long_rad / 2.0 / math.pi * 360.0
+
+	return (lat,long)
+
+def _cassini_meridian_many(picked_theta,a,e2):
+	"""How far along the meridian, for the Cassini sums"""
+	e4 = e2 * e2
+	e6 = e2 * e2 * e2
+	return a * (
+		(1.0 - e2/4.0 - 3.0*e4/64.0 - 5.0*e6/256.0) * picked_theta
+	  - (3.0*e2/8.0 + 3.0*e4/32.0 + 45.0*e6/1024.0) * numpy.sin(2.0*picked_theta)
+	  + (15.0*e4/256.0 + 45.0*e6/1024.0) * numpy.sin(4.0*picked_theta)
+	  - (35.0*e6/3072.0) * numpy.sin(6.0*picked_theta)
+	)
+
+def turn_latlong_into_cassini_en_many(lat_dec,long_dec,scheme):
+	"""As per turn_latlong_into_cassini_en, but for arrays of points"""
+
+	a, b, e2 = abe_values[scheme]
+	theta0, landa0, false_easting, false_northing = cassini_values[scheme]
+
+	theta = numpy.asarray(lat_dec, dtype=float) /360.0 *2.0*math.pi
+	landa = numpy.asarray(long_dec, dtype=float) /360.0 *2.0*math.pi
+
+	# Compute intermediate values
+	cos_theta = numpy.cos(theta)
+	sin_theta = numpy.sin(theta)
+	tan_theta = numpy.tan(theta)
+	A = (landa - landa0) * cos_theta
+	T = tan_theta * tan_theta
+	C = e2 / (1.0 - e2) * cos_theta * cos_theta
+	v = a / numpy.sqrt( 1 - (e2 * sin_theta * sin_theta) )
+
+	A2 = A * A
+	M = _cassini_meridian_many(theta,a,e2)
+	M0 = _cassini_meridian_many(theta0,a,e2)
+
+	easting = false_easting + v * (
+				A - T * A2*A / 6.0 - (8.0 - T + 8.0*C) * T * A2*A2*A / 120.0 )
+	northing = false_northing + M - M0 + v * tan_theta * (
+				A2 / 2.0 + (5.0 - T + 6.0*C) * A2*A2 / 24.0 )
+
+	return (easting,northing)
+
+def turn_cassini_en_into_latlong_many(easting,northing,scheme):
+	"""As per turn_cassini_en_into_latlong, but for arrays of points"""
+
+	a, b, e2 = abe_values[scheme]
+	theta0, landa0, false_easting, false_northing = cassini_values[scheme]
+
+	e4 = e2 * e2
+	e6 = e2 * e2 * e2
+
+	easting = numpy.asarray(easting, dtype=float)
+	northing = numpy.asarray(northing, dtype=float)
+
+	# Compute first batch of intermediate values
+	M1 = _cassini_meridian_many(theta0,a,e2) + (northing - false_northing)
+	mu1 = M1 / (a * (1.0 - e2/4.0 - 3.0*e4/64.0 - 5.0*e6/256.0) )
+	e1 = (1 - ((1-e2) ** 0.5)) / (1 + ((1-e2) ** 0.5))
+
+	e1_2 = e1 ** 2
+	e1_3 = e1 ** 3
+	e1_4 = e1 ** 4
+
+	# Now compute theta1 at T1
+	theta1 = mu1 + (
+		+ (3.0*e1 / 2.0 - 27.0*e1_3 / 32.0) * numpy.sin(2.0*mu1)
+		+ (21.0*e1_2 / 16.0 - 55.0*e1_4 / 32.0) * numpy.sin(4.0*mu1)
+		+ (151.0*e1_3 / 96.0) * numpy.sin(6.0*mu1)
+		+ (1097.0*e1_4 / 512.0) * numpy.sin(8.0*mu1)
+	)
+	tan_theta1 = numpy.tan(theta1)
+	sin_theta1 = numpy.sin(theta1)
+	T1 = tan_theta1 ** 2
+
+	# Now we can find v1, ro1 and D
+	v1 = a / numpy.sqrt( 1.0 - (e2 * sin_theta1 * sin_theta1) )
+	ro1 = a * (1 - e2) / ((1 - e2 * sin_theta1 * sin_theta1) ** 1.5)
+	D = (easting - false_easting) / v1
+	D2 = D * D
+
+	# And finally the lat and long
+	lat = theta1 - (v1 * tan_theta1) / ro1 * (
+			D2/2.0 - (1.0 + 3.0 * T1) * ( D2*D2 / 24.0 ) )
+	long = landa0 + (
+				D - T1 * D2*D / 3.0 + (1 + 3.0 * T1) * T1 * D2*D2*D / 15.0
+			) / numpy.cos(theta1)
+
+	# Now make decimal versions
+	lat_dec = lat * 360.0 / 2.0 / math.pi
+	long_dec = long * 360.0 / 2.0 / math.pi
+
+	return (lat_dec,long_dec)
+
 ##############################################################
 #             OS Specific Methods Follow                     #
 ##############################################################
@@ -22,9 +22,10 @@ import os
 import math
 import zipfile
 
+import numpy
 import Image, ImageChops, ImageDraw
 
-from osgrid_to_wgs84 import osref_to_en, wgs84_to_en
+from osgrid_to_wgs84 import osref_to_en
 
 import pc
 
@@ -84,26 +85,17 @@ def pc_map():
 
     points = []
 
-    def callback(idx, *record):
-        postcode, lat, lon, osref = record
-        if '\0' in osref:
-            return
-        e, n = osref_to_en(osref)
-        e, n = scale_en(e, n)
-        points.append((e, n))
-
     print >> sys.stderr, "reading all points"
     path = pc.get_db_name()
-    pc.visit(path, callback)
+    for batch in pc.visit_batches(path):
+        e, n = batch["east"] / MAP_SCALE, batch["north"] / MAP_SCALE
+        points.append((e.astype(numpy.int64) << 32) | n)
 
     print >> sys.stderr, "count points"
+    points, counts = numpy.unique(numpy.concatenate(points), return_counts=True)
     gb = {}
-    for x, y in points:
-        if not gb.get((x,y)):
-            gb[(x,y)] = 1
-        else:
-            v = gb[(x,y)] + 1
-            gb[(x,y)] = v
+    for point, num in zip(points.tolist(), counts.tolist()):
+        gb[(point >> 32, point & 0xffffffff)] = num
 
     print >> sys.stderr, "make histogram"
     hist = Hist()
@@ -192,6 +184,9 @@ def make_county_map(colour):
     base = make_county_db()
     gb = Map()
 
+    # pixels are MAP_SCALE metres, so a metre or so is plenty
+    to_en = pc.get_transformer("wgs84", "en", precision=1.0).point
+
     for fname in os.listdir(base):
         points = []
         if not fname.endswith("ALL.txt"):
@@ -208,7 +203,7 @@ def make_county_map(colour):
                 points = []
                 continue
             lat, lon = [ float(x) for x in line.split(",") ]
-            e, n = wgs84_to_en(lat, lon)
+            e, n = to_en(lat, lon)
             e, n = scale_en(e, n)
             if mine <= e <= maxe:
                 if minn <= n <= maxn:
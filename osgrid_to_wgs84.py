@@ -19,6 +19,15 @@
 
 import csv
 import sys
+import os
+import math
+import struct
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # only needed for arrays of points
 
 # import geo_helper, see http://gagravarr.org/code/
 import geo_helper
@@ -33,42 +42,437 @@ grid = [
     [ 'A', 'B', 'C', 'D', 'E' ],
 ]
 
+# letter : (x, y) in the grid above, as 500km / 100km squares
+
+letters = {}
+for y, row in enumerate(grid):
+    for x, cell in enumerate(row):
+        letters[cell] = x, y
+
 def cell_to_xy(cell):
-    for y in range(5):
-        if cell in grid[y]:
-            x = grid[y].index(cell)
-            return x, y
-    raise ValueError
+    try:
+        return letters[cell]
+    except KeyError:
+        raise ValueError(cell)
 
 def grid_to_xy(area):
     x1, y1 = cell_to_xy(area[0])
     x2, y2 = cell_to_xy(area[1])
     return (100 * (x2 + (5 * (x1 - 2)))), (100 * (y2 + (5 * (y1 - 1))))
 
+# metres per unit for each number of digits per axis
+digit_scale = { 1 : 10000, 2 : 1000, 3 : 100, 4 : 10, 5 : 1 }
+
 def osref_to_en(osref):
     region, osref = osref[:2], osref[2:]
     if region == "AA":
         return 0.0, 0.0
-    digits = len(osref)/2
-    east, north = osref[:digits], osref[digits:]
+    if len(region) != 2:
+        raise ValueError(region)
     # get "XX" region in km east,north
     e, n = grid_to_xy(region)
-    # convert to km. Digits ABCDE.. are 10km, 1km, 100m, 10m, 1m, ...
-    if digits == 4:
-        div = 100.0
-    elif digits == 3:
-        div = 10.0
-    elif digits == 2:
-        div = 1.0
-    east, north = [ (int(x,10)/div) for x in [ east, north ] ]
+    digits = len(osref) / 2
+    scale = digit_scale.get(digits)
+    # int() would also take spaces and signs
+    if scale is None or len(osref) != 2 * digits or not osref.isdigit():
+        raise ValueError(osref)
+    east, north = int(osref[:digits], 10), int(osref[digits:], 10)
     # full OS grid ref east, northings in metres
-    e, n = 1000 * (e + east), 1000 * (n + north)
-    return e, n
+    return float((1000 * e) + (east * scale)), float((1000 * n) + (north * scale))
+
+#
+#   Parse an array of OS refs (as numpy "S<n>") into int32 eastings,
+#   northings in metres, and a mask of the refs that were well formed.
+
+if numpy:
+    letter_x = numpy.full(256, -1, dtype=numpy.int32)
+    letter_y = numpy.full(256, -1, dtype=numpy.int32)
+    for cell, (x, y) in letters.items():
+        letter_x[ord(cell)], letter_y[ord(cell)] = x, y
+
+def osrefs_to_en(osrefs):
+    osrefs = numpy.ascontiguousarray(osrefs)
+    count, width = len(osrefs), osrefs.dtype.itemsize
+    chars = osrefs.view(numpy.uint8).reshape(count, width).astype(numpy.int32)
+    e = numpy.zeros(count, dtype=numpy.int32)
+    n = numpy.zeros(count, dtype=numpy.int32)
+    if width < 2:
+        return e, n, numpy.zeros(count, dtype=bool)
 
-    # in the form "SXxxxyyy"
-    grid, e, n = osref[:2], int(osref[2:5], 10), int(osref[5:], 10)
-    xx, yy = grid_to_xy(grid)
-    return (xx*10) + e, (yy*10) + n
+    # the 100km square, from the letter table
+    x1, y1 = letter_x[chars[:,0]], letter_y[chars[:,0]]
+    x2, y2 = letter_x[chars[:,1]], letter_y[chars[:,1]]
+    ok = (x1 >= 0) & (x2 >= 0)
+    e[:] = 100000 * (x2 + (5 * (x1 - 2)))
+    n[:] = 100000 * (y2 + (5 * (y1 - 1)))
+
+    # numpy "S" strings are null padded
+    length = width - numpy.cumprod(chars[:,::-1] == 0, axis=1).sum(axis=1)
+    digits = chars[:,2:] - ord("0")
+    is_digit = (digits >= 0) & (digits <= 9)
+    for d, scale in digit_scale.items():
+        rows = (length == 2 + (2 * d))
+        if not rows.any():
+            continue
+        dd = digits[rows]
+        good = is_digit[rows][:,:2*d].all(axis=1)
+        weights = scale * (10 ** numpy.arange(d - 1, -1, -1))
+        e[rows] += (dd[:,:d] * weights).sum(axis=1)
+        n[rows] += (dd[:,d:2*d] * weights).sum(axis=1)
+        ok[rows] &= good
+    ok &= numpy.in1d(length, [ 2 + (2 * d) for d in digit_scale ])
+
+    # "AA" is no location, at 0, 0
+    aa = (chars[:,0] == ord("A")) & (chars[:,1] == ord("A"))
+    ok |= aa
+    e[aa | ~ok], n[aa | ~ok] = 0, 0
+    return e, n, ok
+
+#
+#   Transformer : a conversion between two coordinate systems with every
+#   constant worked out up front. The systems are "wgs84" and "osgb36"
+#   (decimal lat, lon) and "en" (OSGB36 eastings, northings in metres).
+#   point() converts one point, many() arrays of them (needs numpy).
+
+class MathOps:
+    sin, cos, tan, sqrt, atan = math.sin, math.cos, math.tan, math.sqrt, math.atan
+
+class NumpyOps:
+    if numpy:
+        sin, cos, tan = numpy.sin, numpy.cos, numpy.tan
+        sqrt, atan = numpy.sqrt, numpy.arctan
+
+rad = math.pi / 180.0
+deg = 180.0 / math.pi
+
+def ll_to_xyz(system, ops):
+    # lat, lon at height 0 to cartesian x, y, z
+    a, b, e2 = geo_helper.abe_values[system]
+    sin, cos, sqrt = ops.sin, ops.cos, ops.sqrt
+    def fn(lat, lon):
+        theta, landa = lat * rad, lon * rad
+        sin_theta, cos_theta = sin(theta), cos(theta)
+        v = a / sqrt(1.0 - e2 * sin_theta * sin_theta)
+        return (v * cos_theta * cos(landa), v * cos_theta * sin(landa),
+                (1.0 - e2) * v * sin_theta)
+    return fn
+
+def helmert(src, dst):
+    tx, ty, tz, s, rx, ry, rz = geo_helper.transform_values[src + "_to_" + dst]
+    s1 = 1.0 + s
+    def fn(x, y, z):
+        return (tx + (s1 * x) - (rz * y) + (ry * z),
+                ty + (rz * x) + (s1 * y) - (rx * z),
+                tz - (ry * x) + (rx * y) + (s1 * z))
+    return fn
+
+def xyz_to_ll(system, ops):
+    a, b, e2 = geo_helper.abe_values[system]
+    sin, sqrt, atan = ops.sin, ops.sqrt, ops.atan
+    k = 1.0 - e2
+    def fn(x, y, z):
+        p = sqrt(x*x + y*y)
+        sin_init = sin(atan(z / (p * k)))
+        v = a / sqrt(1.0 - e2 * sin_init * sin_init)
+        return atan((z + e2 * v * sin_init) / p) * deg, atan(y / x) * deg
+    return fn
+
+def meridian(scheme, ops):
+    # M, the Transverse Mercator meridional arc, as a function of theta
+    n0, e0, f0, theta0, landa0 = geo_helper.en_values[scheme]
+    a, b, e2 = geo_helper.abe_values[scheme]
+    sin, cos = ops.sin, ops.cos
+    n = (a - b) / (a + b)
+    c1 = b * f0 * (1.0 + n + 5.0/4.0*n*n + 5.0/4.0*n*n*n)
+    c2 = b * f0 * (3.0*n + 3.0*n*n + 21.0/8.0*n*n*n)
+    c3 = b * f0 * (15.0/8.0*n*n + 15.0/8.0*n*n*n)
+    c4 = b * f0 * (35.0/24.0*n*n*n)
+    def fn(theta):
+        d, s = theta - theta0, theta + theta0
+        return ((c1 * d) - (c2 * sin(d) * cos(s))
+                + (c3 * sin(2.0 * d) * cos(2.0 * s))
+                - (c4 * sin(3.0 * d) * cos(3.0 * s)))
+    return fn
+
+def ll_to_en(scheme, ops):
+    n0, e0, f0, theta0, landa0 = geo_helper.en_values[scheme]
+    a, b, e2 = geo_helper.abe_values[scheme]
+    sin, cos, tan = ops.sin, ops.cos, ops.tan
+    M = meridian(scheme, ops)
+    af0 = a * f0
+    def fn(lat, lon):
+        theta = lat * rad
+        sin_theta, cos_theta = sin(theta), cos(theta)
+        t2 = tan(theta) ** 2
+        w = 1.0 - e2 * sin_theta * sin_theta
+        v = af0 * w ** -0.5
+        ro = af0 * (1.0 - e2) * w ** -1.5
+        nu2 = v / ro - 1.0
+        cos3 = cos_theta ** 3
+        cos5 = cos3 * cos_theta * cos_theta
+
+        II = v / 2.0 * sin_theta * cos_theta
+        III = v / 24.0 * sin_theta * cos3 * (5.0 - t2 + 9.0 * nu2)
+        IIIa = v / 720.0 * sin_theta * cos5 * (61.0 - 58.0 * t2 + t2 * t2)
+        IV = v * cos_theta
+        V = v / 6.0 * cos3 * (v / ro - t2)
+        VI = v / 120.0 * cos5 * (5.0 - 18.0 * t2 + t2 * t2 + 14.0 * nu2
+                                 - 58.0 * t2 * nu2)
+
+        dl = lon * rad - landa0
+        dl2 = dl * dl
+        north = M(theta) + n0 + dl2 * (II + dl2 * (III + dl2 * IIIa))
+        east = e0 + dl * (IV + dl2 * (V + dl2 * VI))
+        return east, north
+    return fn
+
+def en_to_ll(scheme, ops):
+    n0, e0, f0, theta0, landa0 = geo_helper.en_values[scheme]
+    a, b, e2 = geo_helper.abe_values[scheme]
+    sin, cos, tan = ops.sin, ops.cos, ops.tan
+    M = meridian(scheme, ops)
+    af0 = a * f0
+    def fn(east, north):
+        # iterate, 4 times should be enough
+        theta = ((north - n0) / af0) + theta0
+        for i in range(3):
+            theta = ((north - n0 - M(theta)) / af0) + theta
+
+        sin_theta = sin(theta)
+        w = 1.0 - e2 * sin_theta * sin_theta
+        v = af0 * w ** -0.5
+        ro = af0 * (1.0 - e2) * w ** -1.5
+        nu2 = v / ro - 1.0
+        tan_theta = tan(theta)
+        t2 = tan_theta * tan_theta
+        sec = 1.0 / cos(theta)
+        v2 = v * v
+
+        VII = tan_theta / (2.0 * ro * v)
+        VIII = VII / (12.0 * v2) * (5.0 + 3.0 * t2 + nu2 - 9.0 * t2 * nu2)
+        IX = VII / (360.0 * v2 * v2) * (61.0 + 90.0 * t2 + 45.0 * t2 * t2)
+        X = sec / v
+        XI = X / (6.0 * v2) * (v / ro + 2.0 * t2)
+        XII = X / (120.0 * v2 * v2) * (5.0 + 28.0 * t2 + 24.0 * t2 * t2)
+        XIIa = X / (5040.0 * v2 * v2 * v2) * (61.0 + 662.0 * t2
+                        + 1320.0 * t2 * t2 + 720.0 * t2 * t2 * t2)
+
+        de = east - e0
+        de2 = de * de
+        lat = theta - de2 * (VII - de2 * (VIII - de2 * IX))
+        lon = landa0 + de * (X - de2 * (XI - de2 * (XII - de2 * XIIa)))
+        return lat * deg, lon * deg
+    return fn
+
+# the steps between neighbouring systems
+datum_steps = {
+    ("wgs84", "osgb36") : lambda ops : [
+        ll_to_xyz("wgs84", ops), helmert("wgs84", "osgb"), xyz_to_ll("osgb", ops) ],
+    ("osgb36", "wgs84") : lambda ops : [
+        ll_to_xyz("osgb", ops), helmert("osgb", "wgs84"), xyz_to_ll("wgs84", ops) ],
+    ("osgb36", "en") : lambda ops : [ ll_to_en("osgb", ops) ],
+    ("en", "osgb36") : lambda ops : [ en_to_ll("osgb", ops) ],
+}
+
+def chain(src, dst, ops):
+    if (src, dst) in datum_steps:
+        return datum_steps[(src, dst)](ops)
+    # go via osgb36
+    if src == dst or "osgb36" in (src, dst):
+        raise ValueError("no transform from %s to %s" % (src, dst))
+    return chain(src, "osgb36", ops) + chain("osgb36", dst, ops)
+
+def fuse(steps):
+    if len(steps) == 1:
+        return steps[0]
+    def fn(*args):
+        for step in steps:
+            args = step(*args)
+        return args
+    return fn
+
+class Transformer:
+
+    def __init__(self, src, dst):
+        self.src, self.dst = src, dst
+        self.point = fuse(chain(src, dst, MathOps))
+        self.vector = None # made on first use, as it needs numpy
+
+    def many(self, a, b):
+        if self.vector is None:
+            self.vector = fuse(chain(self.src, self.dst, NumpyOps))
+        a = numpy.asarray(a, dtype=numpy.float64)
+        b = numpy.asarray(b, dtype=numpy.float64)
+        return self.vector(a, b)
+
+#
+#   Fast approximate transforms from a lat, lon system, by bilinear
+#   interpolation in a table of exact results over the UK. The table is
+#   built at the coarsest step whose error bound meets the precision
+#   asked for, and is saved in the caller's cache directory, if one is
+#   given. Points off the table, and precisions finer than any table, are
+#   converted exactly.
+
+lut_area = (49.0, -11.0, 62.0, 3.0) # lat0, lon0, lat1, lon1
+lut_steps = [ 0.4, 0.2, 0.1, 0.05, 0.025, 0.0125 ] # degrees
+fmt_lut = "=ddddIId" # the last is the error bound, in metres
+lut_version = 3 # bump when the table files change
+
+def lut_scales(dst):
+    # metres per unit of the outputs
+    if dst == "en":
+        return 1.0, 1.0
+    # degrees to metres, a degree of lon being longest at the south
+    metres = rad * geo_helper.earths_radius
+    return metres, metres * math.cos(lut_area[0] * rad)
+
+def lut_bound(dst, a, b):
+    # bilinear interpolation is out by at most h^2 |f''| / 8 along each
+    # axis. Take f'' h^2 from the second differences of the table, with
+    # some slack for its change within a cell. This is an estimate : see
+    # lut_error() for the error actually found.
+    scales = lut_scales(dst)
+    bound = 0.0
+    for f, scale in zip((a, b), scales):
+        d_row = numpy.abs(f[2:,:] - (2 * f[1:-1,:]) + f[:-2,:]).max()
+        d_col = numpy.abs(f[:,2:] - (2 * f[:,1:-1]) + f[:,:-2]).max()
+        bound += (scale * (d_row + d_col) / 8.0) ** 2
+    return math.sqrt(bound) * 1.5
+
+def make_lut(src, dst, step):
+    lat0, lon0, lat1, lon1 = lut_area
+    nrows = int(round((lat1 - lat0) / step)) + 1
+    ncols = int(round((lon1 - lon0) / step)) + 1
+    lats = lat0 + (numpy.arange(nrows) * step)
+    lons = lon0 + (numpy.arange(ncols) * step)
+    lon, lat = numpy.meshgrid(lons, lats)
+    a, b = transformer(src, dst).many(lat, lon)
+    # the error is largest mid cell, so check it there too
+    bound = max(lut_bound(dst, a, b), lut_error(src, dst, step, a, b))
+    return (lat0, lon0, step, step, nrows, ncols, bound), a, b
+
+def lut_error(src, dst, step, a, b):
+    # the largest error, in metres, at the cell centres, where the
+    # interpolation is the mean of the four corners
+    nrows, ncols = a.shape
+    lats = lut_area[0] + ((numpy.arange(nrows - 1) + 0.5) * step)
+    lons = lut_area[1] + ((numpy.arange(ncols - 1) + 0.5) * step)
+    lon, lat = numpy.meshgrid(lons, lats)
+    exact = transformer(src, dst).many(lat, lon)
+    error = 0.0
+    for f, g, scale in zip((a, b), exact, lut_scales(dst)):
+        mid = (f[:-1,:-1] + f[:-1,1:] + f[1:,:-1] + f[1:,1:]) / 4.0
+        error = error + ((scale * (mid - g)) ** 2)
+    return math.sqrt(error.max())
+
+def load_lut(src, dst, step, cache_dir=None):
+    if cache_dir is None:
+        return make_lut(src, dst, step)
+
+    name = "lut%d_%s_%s_%g.dat" % (lut_version, src, dst, step)
+    path = os.path.join(cache_dir, name)
+    if os.path.exists(path):
+        f = open(path, "rb")
+        header = struct.unpack(fmt_lut, f.read(struct.calcsize(fmt_lut)))
+        nrows, ncols = header[4:6]
+        a = numpy.fromfile(f, dtype=numpy.float64, count=nrows*ncols)
+        b = numpy.fromfile(f, dtype=numpy.float64, count=nrows*ncols)
+        f.close()
+        if len(a) == len(b) == nrows*ncols:
+            return header, a.reshape(nrows, ncols), b.reshape(nrows, ncols)
+        # short file, make it again
+
+    header, a, b = make_lut(src, dst, step)
+    if not os.path.exists(cache_dir):
+        os.mkdir(cache_dir)
+    # another process may be writing the same table
+    fd, part = tempfile.mkstemp(suffix=".part", dir=cache_dir)
+    f = os.fdopen(fd, "wb")
+    f.write(struct.pack(fmt_lut, *header))
+    a.tofile(f)
+    b.tofile(f)
+    f.close()
+    os.rename(part, path)
+    return header, a, b
+
+class LutTransformer:
+
+    def __init__(self, src, dst, precision, cache_dir=None):
+        if src == "en":
+            raise ValueError("no table transform from %s" % src)
+        self.src, self.dst = src, dst
+        self.exact = transformer(src, dst)
+        for step in lut_steps:
+            header, a, b = load_lut(src, dst, step, cache_dir)
+            if header[-1] <= precision:
+                break
+        else:
+            raise ValueError("no table is within %gm" % precision)
+        self.lat0, self.lon0, self.dlat, self.dlon, \
+                self.nrows, self.ncols, self.error = header
+        self.a, self.b = a, b
+        # flat lists are quicker than numpy for single points
+        self.a_list, self.b_list = a.ravel().tolist(), b.ravel().tolist()
+
+    def point(self, lat, lon):
+        y = (lat - self.lat0) / self.dlat
+        x = (lon - self.lon0) / self.dlon
+        row, col = int(math.floor(y)), int(math.floor(x))
+        if not ((0 <= row < self.nrows - 1) and (0 <= col < self.ncols - 1)):
+            return self.exact.point(lat, lon)
+        fy, fx = y - row, x - col
+        i = (row * self.ncols) + col
+        j = i + self.ncols
+        a, b = self.a_list, self.b_list
+        a0 = a[i] + (fx * (a[i+1] - a[i]))
+        a1 = a[j] + (fx * (a[j+1] - a[j]))
+        b0 = b[i] + (fx * (b[i+1] - b[i]))
+        b1 = b[j] + (fx * (b[j+1] - b[j]))
+        return a0 + (fy * (a1 - a0)), b0 + (fy * (b1 - b0))
+
+    def many(self, lat, lon):
+        lat = numpy.asarray(lat, dtype=numpy.float64)
+        lon = numpy.asarray(lon, dtype=numpy.float64)
+        y = (lat - self.lat0) / self.dlat
+        x = (lon - self.lon0) / self.dlon
+        row, col = numpy.floor(y), numpy.floor(x)
+        inside = (row >= 0) & (row < self.nrows - 1) & \
+                 (col >= 0) & (col < self.ncols - 1)
+        row = numpy.where(inside, row, 0).astype(numpy.intp)
+        col = numpy.where(inside, col, 0).astype(numpy.intp)
+        fy, fx = y - row, x - col
+
+        def lerp(f):
+            f00, f01 = f[row, col], f[row, col + 1]
+            f10, f11 = f[row + 1, col], f[row + 1, col + 1]
+            f0 = f00 + (fx * (f01 - f00))
+            f1 = f10 + (fx * (f11 - f10))
+            return f0 + (fy * (f1 - f0))
+
+        a, b = lerp(self.a), lerp(self.b)
+        if not inside.all():
+            outside = ~inside
+            a[outside], b[outside] = self.exact.many(lat[outside], lon[outside])
+        return a, b
+
+transformers = {}
+
+def transformer(src, dst, precision=None, cache_dir=None):
+    """ precision, in metres, allows a faster approximate transform;
+        its tables are kept in cache_dir, or only in memory if None """
+    key = (src, dst, precision, cache_dir)
+    t = transformers.get(key)
+    if t is None:
+        if (precision is None) or (numpy is None):
+            t = Transformer(src, dst)
+        else:
+            try:
+                t = LutTransformer(src, dst, precision, cache_dir)
+            except ValueError:
+                # too fine for the tables
+                t = transformer(src, dst)
+        transformers[key] = t
+    return t
 
 #
 #
@@ -77,21 +481,32 @@ def convert(osref):
     """ Converts n figure OS Grid reference into WGS84 lat/lon """
     # full OS grid ref east, northings in metres
     e, n = osref_to_en(osref)
-    # convert to OSGB36
-    la, lo = geo_helper.turn_eastingnorthing_into_osgb36(e, n)
-    # convert to WGS84
-    lat, lon, h = geo_helper.turn_osgb36_into_wgs84(la, lo, 0.0)
-    return lat, lon
-
-def wgs84_to_en(lat, lon):
-    # convert to OSGB36
-    lat, lon, h = geo_helper.turn_wgs84_into_osgb36(lat, lon, 0.0)
-    # convert to OS eastings, northings in metres
-    e, n = geo_helper.turn_osgb36_into_eastingnorthing(lat, lon)
-    return e, n
+    return transformer("en", "wgs84").point(e, n)
+
+def wgs84_to_en(lat, lon, precision=None):
+    # OS eastings, northings in metres
+    return transformer("wgs84", "en", precision).point(lat, lon)
 
 def osgb36_to_wgs84(lat, lon):
-    lat, lon, h = geo_helper.turn_osgb36_into_wgs84(lat, lon, 0.0)
-    return lat, lon
+    return transformer("osgb36", "wgs84").point(lat, lon)
+
+#
+#   As above, for arrays of points. Needs numpy.
+
+def convert_many(osrefs):
+    """ Converts a sequence of OS Grid references into WGS84 lat/lon arrays """
+    e, n, ok = osrefs_to_en(numpy.asarray(osrefs, dtype="S"))
+    if not ok.all():
+        raise ValueError(numpy.asarray(osrefs)[~ok][0])
+    return en_to_wgs84_many(e, n)
+
+def en_to_wgs84_many(e, n):
+    return transformer("en", "wgs84").many(e, n)
+
+def wgs84_to_en_many(lat, lon, precision=None):
+    return transformer("wgs84", "en", precision).many(lat, lon)
+
+def osgb36_to_wgs84_many(lat, lon):
+    return transformer("osgb36", "wgs84").many(lat, lon)
 
 # FIN
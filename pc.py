@@ -24,24 +24,47 @@ import os
 import bz2
 import zipfile
 import re
+import heapq
+import tempfile
+import mmap
+import math
 import optparse
+import json
+import zlib
+import marshal
+import hashlib
+import fcntl
+import multiprocessing
+import threading
+import time
+
+import numpy
 
 from osgrid_to_wgs84 import convert as to_wgs84
-from osgrid_to_wgs84 import osgb36_to_wgs84
+from osgrid_to_wgs84 import osrefs_to_en, wgs84_to_en, transformer
+from geo_helper import earths_radius
 
 pcpath = "/usr/local/data/books/uk-post-codes-2009.bz2"
 gazpath = "/usr/local/data/books/gaz50k2014_gb.zip"
 
-fmt = "=8sdd8s"
+fmt = "=8sdd8siidd"
 
 cache_base = "/tmp/.postcode/"
-txt_name = "pc.csv"
 db_name = "pc.dat"
 lat_name = "lat.dat"
 lon_name = "lon.dat"
 os_name = "os.dat"
+grid_name = "grid.dat"
+wgs_grid_name = "grid.wgs84.dat"
 gaz_name = "gaz"
 county_name = "gaz.county.dat"
+complete_name = "gaz.complete"
+fuzzy_name = "gaz.fuzzy"
+manifest_name = "manifest.json"
+lock_name = "build.lock"
+
+# bump this when any of the file formats change
+format_version = 3
 
 #
 #   Make db and index files
@@ -52,41 +75,21 @@ def get_name(other):
 def get_db_name():
     return get_name(db_name)
 
-#
-#   Decompress the bz2 source into a csv file.
-
-def make_txt(opath):
-    if not os.path.exists(cache_base):
-        print >> sys.stderr, "mkdir", cache_base
-        os.mkdir(cache_base)
-
-    # bunzip2 <src.bz2>
-    print >> sys.stderr, "creating", opath
-    ifile = open(pcpath, "rb")
-    ofile = open(opath, "wb")
-    decompressor = bz2.BZ2Decompressor()
-
-    BLOCK = 1024
-    while True:
-        data = ifile.read(BLOCK)
-        if not data:
-            break
-        decom = decompressor.decompress(data)
-        ofile.write(decom)
-    ifile.close()
-    ofile.close()
+def get_transformer(src, dst, precision=None):
+    # keeps any lookup tables with the db files
+    return transformer(src, dst, precision, cache_base)
 
 #
-#   Create a binary file : "postcode", lat, lon
-#   sorted by postcode.
+#   Create a binary file : "postcode", lat, lon, osref, sorted by postcode,
+#   with the OS easting, northing (metres) and WGS84 lat, lon of each.
+#   Streams the csv straight out of the bz2 source, packing as it goes.
 
-def make_db(ipath, opath):
-    if not os.path.exists(ipath):
-        make_txt(ipath)
+BLOCK = 1024 * 1024
 
-    f = open(ipath, "r")
+def make_db(ipath, opath):
+    f = bz2.BZ2File(ipath, "r", BLOCK)
     reader = csv.reader(f, delimiter=",")
-    data = []
+    data = ExternalSort(db_src_dtype)
 
     print >> sys.stderr, "reading %s ..." % ipath
 
@@ -99,7 +102,7 @@ def make_db(ipath, opath):
         if pc.startswith("GIR"):
             continue # ignore this weird one
 
-        lat, lon = [ float(x) for x in row[13:15] ]
+        lon, lat = [ float(x) for x in row[13:15] ]
 
         # lots of entries have no location data in ... yet
         if (lon == 0.0) and (lat == 0.0):
@@ -109,57 +112,99 @@ def make_db(ipath, opath):
         osref = row[15]
         # Keep the 6-figure part
         osref = osref[:5] + osref[7:10]
-        # lat,lon are in OSGB36, so convert to WGS84
-        #lat, lon = osgb36_to_wgs84(lat, lon)
-        data.append((pc, lat, lon, osref))
-
-    print >> sys.stderr, "sorting ..."
-
-    data.sort()
+        data.add((pc, lat, lon, osref))
 
-    print >> sys.stderr, "writing %s ..." % opath
-    ofile = open(opath, "wb")
-
-    for pc, lon, lat, osref in data:
-        binary = struct.pack(fmt, pc, lat, lon, osref)
-        ofile.write(binary)
+    f.close()
 
-    ofile.close()
+    print >> sys.stderr, "sorting, writing %s ..." % opath
+    write_db(opath, data)
+
+def write_db(path, data):
+    # lat,lon are in OSGB36, so convert each batch to E/N and WGS84
+    en = transformer("osgb36", "en")
+    wgs84 = transformer("osgb36", "wgs84")
+    fout = open(path, "wb")
+    for batch in data.batches():
+        out = numpy.empty(len(batch), dtype=db_dtype)
+        for field in db_src_dtype.names:
+            out[field] = batch[field]
+        east, north = en.many(batch["lat"], batch["lon"])
+        out["east"], out["north"] = numpy.rint(east), numpy.rint(north)
+        out["wgs_lat"], out["wgs_lon"] = wgs84.many(batch["lat"], batch["lon"])
+        out.tofile(fout)
+    fout.close()
 
 #
 #
 
 fmt_idx = "=dI"
 
-def make_idx_db(path, lat_path, lon_path):
-
-    class Index:
-        def __init__(self):
-            self.data = []
-
-        def lat_fn(self, idx, pc, lat, lon, osref):
-            self.data.append((lat, idx))
-
-        def lon_fn(self, idx, pc, lat, lon, osref):
-            self.data.append((lon, idx))
-
-        def write(self, path):
-            self.data.sort()
-            fout = open(path, "wb")
-            for coord, idx in self.data:
-                binary = struct.pack(fmt_idx, coord, idx)
-                fout.write(binary)
-            fout.close()
-
-    print >> sys.stderr, "Making", lat_path
-    data = Index()
-    visit(path, data.lat_fn)
-    data.write(lat_path)
+def make_idx_db(path, lat_path, lon_path, os_path, pool=None):
+    records = num_records(path)
+    itemsize = (2 * idx_dtype.itemsize) + os_dtype.itemsize
+    if (records * itemsize) > sort_budget:
+        # too big to sort in memory
+        return sort_idx_db(path, lat_path, lon_path, os_path)
+
+    print >> sys.stderr, "Making", lat_path, lon_path, os_path
+
+    # one scan to extract all the key columns
+    lats = numpy.empty(records, dtype=idx_dtype["coord"])
+    lons = numpy.empty(records, dtype=idx_dtype["coord"])
+    osrefs = numpy.empty(records, dtype=os_dtype["osref"])
+    start = 0
+    for batch in visit_batches(path):
+        end = start + len(batch)
+        lats[start:end] = batch["lat"]
+        lons[start:end] = batch["lon"]
+        osrefs[start:end] = batch["osref"]
+        start = end
+
+    idxs = numpy.arange(records, dtype=numpy.uint32)
+    # skip records with no OS ref
+    found = osrefs != ""
+
+    tasks = [
+        (lat_path, idx_dtype, lats, idxs),
+        (lon_path, idx_dtype, lons, idxs),
+        (os_path, os_dtype, osrefs[found], idxs[found]),
+    ]
+
+    # sort and write each index in parallel
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(build_jobs)
+    results = [ pool.apply_async(write_index, task) for task in tasks ]
+    for result in results:
+        result.get()
+    if own_pool:
+        pool.close()
+        pool.join()
 
-    print >> sys.stderr, "Making", lon_path
-    data = Index()
-    visit(path, data.lon_fn)
-    data.write(lon_path)
+#
+#   As make_idx_db, but with bounded memory
+
+def sort_idx_db(path, lat_path, lon_path, os_path):
+    # the sorts share the memory budget
+    lats = ExternalSort(idx_dtype, sort_budget / 3)
+    lons = ExternalSort(idx_dtype, sort_budget / 3)
+    osrefs = ExternalSort(os_dtype, sort_budget / 3)
+
+    print >> sys.stderr, "Sorting", lat_path, lon_path, os_path
+    start = 0
+    for batch in visit_batches(path):
+        idxs = numpy.arange(start, start + len(batch), dtype=numpy.uint32)
+        lats.add_array(make_index(idx_dtype, batch["lat"], idxs))
+        lons.add_array(make_index(idx_dtype, batch["lon"], idxs))
+        osref = batch["osref"]
+        # skip records with no OS ref
+        found = osref != ""
+        osrefs.add_array(make_index(os_dtype, osref[found], idxs[found]))
+        start += len(batch)
+
+    write_sorted(lat_path, lats)
+    write_sorted(lon_path, lons)
+    write_sorted(os_path, osrefs)
 
 def get_record_idx(ifile, idx):
     itemsize = struct.calcsize(fmt_idx)
@@ -168,42 +213,202 @@ def get_record_idx(ifile, idx):
     return struct.unpack(fmt_idx, blob)
 
 #
-#   Make index for OS map reference
+#   Index for OS map reference, made by make_idx_db()
 
 fmt_os = "=8sI"
 
-def make_os_db(path, os_path):
+#
+#   Make a 2-D index of lat / lon.
+#   The records in each grid cell are stored as one contiguous run of
+#   db idxs, cells in row (lat) order. A run of cells along a row is
+#   therefore also contiguous.
+
+fmt_grid = "=ddddII"
+grid_cell = 0.01 # degrees
+
+def make_grid_db(path, grid_path, wgs_grid_path):
+    lats, lons, wgs_lats, wgs_lons = [], [], [], []
+
+    print >> sys.stderr, "Making", grid_path, wgs_grid_path
+    for batch in visit_batches(path):
+        lats.append(batch["lat"])
+        lons.append(batch["lon"])
+        wgs_lats.append(batch["wgs_lat"])
+        wgs_lons.append(batch["wgs_lon"])
+
+    # of the source (OSGB36) lat, lon for get_range(),
+    # and of the WGS84 lat, lon for nearest()
+    write_grid(grid_path, numpy.concatenate(lats), numpy.concatenate(lons),
+               grid_cell)
+    write_grid(wgs_grid_path, numpy.concatenate(wgs_lats),
+               numpy.concatenate(wgs_lons), grid_cell)
+
+def write_grid(path, ys, xs, cell, ids=None):
+    y0, x0 = ys.min(), xs.min()
+    rows = ((ys - y0) / cell).astype(numpy.int64)
+    cols = ((xs - x0) / cell).astype(numpy.int64)
+    nrows, ncols = int(rows.max()) + 1, int(cols.max()) + 1
+    cells = (rows * ncols) + cols
+
+    # stable sort, so each cell's idxs stay in db order
+    order = numpy.argsort(cells, kind="mergesort").astype(numpy.uint32)
+    if ids is not None:
+        order = ids[order].astype(numpy.uint32)
+    counts = numpy.bincount(cells, minlength=nrows * ncols)
+    starts = numpy.zeros(len(counts) + 1, dtype=numpy.uint32)
+    numpy.cumsum(counts, out=starts[1:])
+
+    fout = open(path, "wb")
+    header = (y0, x0, cell, cell, nrows, ncols)
+    fout.write(struct.pack(fmt_grid, *header))
+    starts.tofile(fout)
+    order.tofile(fout)
+    fout.close()
 
-    class Index:
-        def __init__(self):
-            self.data = []
+#
+#   Write an index of (key, idx) records, sorted by key then idx
 
-        def handler(self, idx, pc, lat, lon, osref):
-            if osref[0]:
-                self.data.append((osref, idx))
+def write_index(path, dtype, keys, idxs):
+    # stable sort, so equal keys stay in idx order
+    order = numpy.argsort(keys, kind="mergesort")
+    data = numpy.empty(len(order), dtype=dtype)
+    data[dtype.names[0]] = keys[order]
+    data["idx"] = idxs[order]
+    data.tofile(path)
 
-        def write(self, path):
-            self.data.sort()
-            fout = open(path, "wb")
-            for osref, idx in self.data:
-                binary = struct.pack(fmt_os, osref, idx)
-                fout.write(binary)
-            fout.close()
+#
+#   Build an array of (key, idx) index records
 
-    print >> sys.stderr, "Making", os_path
-    data = Index()
-    visit(path, data.handler)
-    data.write(os_path)
+def make_index(dtype, keys, idxs):
+    data = numpy.empty(len(keys), dtype=dtype)
+    data[dtype.names[0]] = keys
+    data["idx"] = idxs
+    return data
+
+#
+#   External merge sort of fixed size records.
+#   Records are held as numpy arrays of dtype. Once more than budget
+#   bytes are held, they are sorted and spilled to a run file in the
+#   cache directory. The sorted runs are then merged with heapq.merge.
+#   Records sort as tuples of their fields would.
+
+sort_budget = 256 * 1024 * 1024
+
+class ExternalSort:
+
+    chunk_rows = 65536
+
+    def __init__(self, dtype, budget=None):
+        if budget is None:
+            budget = sort_budget
+        self.dtype = dtype
+        self.limit = max(budget / dtype.itemsize, 1)
+        self.pending = []
+        self.arrays = []
+        self.held = 0
+        self.runs = []
+
+    def add(self, record):
+        # add a single record tuple
+        self.pending.append(record)
+        if len(self.pending) >= min(self.chunk_rows, self.limit):
+            self.flush()
+
+    def add_array(self, data):
+        self.arrays.append(data)
+        self.held += len(data)
+        if self.held >= self.limit:
+            self.spill()
+
+    def flush(self):
+        if self.pending:
+            data = numpy.array(self.pending, dtype=self.dtype)
+            self.pending = []
+            self.add_array(data)
+
+    def sorted_array(self):
+        if self.arrays:
+            data = numpy.concatenate(self.arrays)
+        else:
+            data = numpy.empty(0, dtype=self.dtype)
+        self.arrays = []
+        self.held = 0
+        data.sort(order=self.dtype.names)
+        return data
+
+    def spill(self):
+        data = self.sorted_array()
+        fd, path = tempfile.mkstemp(suffix=".run", dir=cache_base)
+        f = os.fdopen(fd, "wb")
+        data.tofile(f)
+        f.close()
+        self.runs.append(path)
+
+    def read_run(self, path):
+        f = open(path, "rb")
+        while True:
+            data = numpy.fromfile(f, dtype=self.dtype, count=self.chunk_rows)
+            if not len(data):
+                break
+            for record in data.tolist():
+                yield record
+        f.close()
+
+    def batches(self):
+        # yield the sorted records, as arrays of up to chunk_rows
+        self.flush()
+        if not self.runs:
+            data = self.sorted_array()
+            for i in range(0, len(data), self.chunk_rows):
+                yield data[i:i+self.chunk_rows]
+            return
+
+        if self.held:
+            self.spill()
+        print >> sys.stderr, "merging", len(self.runs), "runs"
+        try:
+            readers = [ self.read_run(path) for path in self.runs ]
+            chunk = []
+            for record in heapq.merge(*readers):
+                chunk.append(record)
+                if len(chunk) == self.chunk_rows:
+                    yield numpy.array(chunk, dtype=self.dtype)
+                    chunk = []
+            if chunk:
+                yield numpy.array(chunk, dtype=self.dtype)
+        finally:
+            for path in self.runs:
+                os.remove(path)
+            self.runs = []
+
+def write_sorted(path, data):
+    fout = open(path, "wb")
+    for batch in data.batches():
+        batch.tofile(fout)
+    fout.close()
 
 #
 #   Read OS gazeteer and create db
 
 idx_fmt = "=IIH6s"
 
-def make_gaz_db(path):
-    if os.path.exists(path + ".idx"):
-        return
+# gaz.idx records, and the records sorted to make them.
+# Only the first gaz_width chars of a name take part in the sort.
+gaz_width = 80
+# feature codes, eg. "C" (city), "F" (forest), "FM" (farm)
+kind_width = 2
+
+gaz_idx_dtype = numpy.dtype([
+    ("county", "=u4"), ("offset", "=u4"), ("length", "=u2"), ("osref", "S6")
+])
+gaz_sort_dtype = numpy.dtype([
+    ("text", "S%d" % gaz_width), ("offset", "=u4"), ("osref", "S6"),
+    ("county", "=u4"), ("length", "=u2"), ("kind", "S%d" % kind_width)
+])
 
+assert gaz_idx_dtype.itemsize == struct.calcsize(idx_fmt)
+
+def make_gaz_db(path, county_path):
     z = zipfile.ZipFile(gazpath, "r")
     names = z.namelist()
     data = None
@@ -223,7 +428,7 @@ def make_gaz_db(path):
     f = open(gaz_text_path, "r")
     reader = csv.reader(f, delimiter=":")
     offset = 0
-    data = []
+    data = ExternalSort(gaz_sort_dtype)
     county_idx = {}
     counties = []
     print >> sys.stderr, "create gaz db"
@@ -240,222 +445,681 @@ def make_gaz_db(path):
         text = text.split("/", 1)[0]
 
         ftext.write(text)
-        data.append((text, offset, osref, county_idx[county]))
+        data.add((text, offset, osref, county_idx[county], len(text), row[14]))
 
         offset += len(text)
 
-    print >> sys.stderr, "sorting gaz"
-    data.sort()
-    print >> sys.stderr, "create gaz index"
-    for idx, (text, offset, osref, cidx) in enumerate(data):
-        length = len(text)
-        raw = struct.pack(idx_fmt, cidx, offset, length, osref)
-        fidx.write(raw)
+    ftext.close()
+
+    print >> sys.stderr, "sorting gaz, create gaz index"
+    fkind = open(path + ".kind", "wb")
+    for batch in data.batches():
+        out = numpy.empty(len(batch), dtype=gaz_idx_dtype)
+        for field in gaz_idx_dtype.names:
+            out[field] = batch[field]
+        out.tofile(fidx)
+        batch["kind"].tofile(fkind)
+    fidx.close()
+    fkind.close()
 
     print >> sys.stderr, "remove", gaz_text_path
     f.close()
     os.unlink(gaz_text_path)
 
     print >> sys.stderr, "write county db"
-    f = open(get_name(county_name), "wb")
+    f = open(county_path, "wb")
     f.write("\0".join(counties))
     f.close()
 
+    make_gram_db(path)
+    make_norm_db(path)
+    make_county_idx(path, len(counties))
+    make_gaz_grid(path)
+
 #
+#   The gaz records by county. gaz.cidx holds the idxs of the records
+#   ordered by (county, name), gaz.cstart the start of each county's run
+#   in it, with a final entry for the end.
+
+def make_county_idx(path, ncounties):
+    print >> sys.stderr, "Making", path + ".cidx"
+    county = numpy.fromfile(path + ".idx", dtype=gaz_idx_dtype)["county"]
+    # the records are sorted by name, so keep that order in each county
+    idxs = numpy.argsort(county, kind="mergesort").astype(numpy.uint32)
+    starts = numpy.searchsorted(county[idxs], numpy.arange(ncounties + 1))
+    idxs.tofile(path + ".cidx")
+    starts.astype(numpy.uint32).tofile(path + ".cstart")
+
+def places_in_county(county):
+    return get_db(gazdb=True).places_in_county(county)
+
 #
+#   Spatial index of the gaz places, on the OS grid.
+#   gaz.en holds each record's easting, northing in metres, at the
+#   centre of its 1km square, or -1 if its osref is bad. gaz.kind holds
+#   each record's feature code. gaz.grid is a grid_name style index of
+#   eastings, northings.
 
-def can_binary_search(match):
-    # return True if regex is just at end of match, or not at all
-    regex_chars = ".*?[]+{}"
-    # TODO :
-    if not any((c in regex_chars) for c in match):
-        return True
-    return False
+gaz_cell = 5000.0 # metres
+
+en_dtype = numpy.dtype([ ("e", "=i4"), ("n", "=i4") ])
+
+def make_gaz_grid(path):
+    print >> sys.stderr, "Making", path + ".grid"
+    osrefs = numpy.fromfile(path + ".idx", dtype=gaz_idx_dtype)["osref"]
+    e, n, ok = osrefs_to_en(osrefs)
+    en = numpy.empty(len(osrefs), dtype=en_dtype)
+    en["e"] = numpy.where(ok, e + 500, -1)
+    en["n"] = numpy.where(ok, n + 500, -1)
+    en.tofile(path + ".en")
+
+    ids = numpy.flatnonzero(en["e"] >= 0)
+    es = en["e"][ids].astype(numpy.float64)
+    ns = en["n"][ids].astype(numpy.float64)
+    write_grid(path + ".grid", ns, es, gaz_cell, ids)
+
+def nearest_place(lat, lon, k=1, kinds=None):
+    return get_db(gazdb=True).nearest_place(lat, lon, k, kinds)
 
 #
-#   Search the gaz for a name
+#   Trigram index of the gaz names, for substring searches.
+#   gaz.gram holds (trigram, start, count) sorted by trigram, each the
+#   run of gaz.post holding the idxs of the names containing it.
+#   Trigrams are of the lower case name, packed into an int.
+
+fmt_gram = "=III"
+gram_dtype = numpy.dtype([
+    ("gram", "=u4"), ("start", "=u4"), ("count", "=u4")
+])
+
+def trigrams(text):
+    grams = set()
+    for i in range(len(text) - 2):
+        a, b, c = text[i:i+3]
+        grams.add((ord(a) << 16) | (ord(b) << 8) | ord(c))
+    return grams
+
+def make_gram_db(path):
+    fidx = Table(path + ".idx", idx_fmt)
+    ftxt = MappedFile(path + ".txt")
+
+    print >> sys.stderr, "Making", path + ".gram"
+    grams, idxs = [], []
+    for idx in range(fidx.records):
+        county_idx, offset, length, osref = fidx.get(idx)
+        name = ftxt.data[offset:offset+length].lower()
+        for gram in trigrams(name):
+            grams.append(gram)
+            idxs.append(idx)
+    fidx.close()
+    ftxt.close()
+
+    grams = numpy.array(grams, dtype=numpy.uint32)
+    idxs = numpy.array(idxs, dtype=numpy.uint32)
+    # by trigram, then idx
+    order = numpy.lexsort((idxs, grams))
+    grams, idxs = grams[order], idxs[order]
+
+    keys, starts, counts = numpy.unique(grams, return_index=True,
+                                        return_counts=True)
+    table = numpy.empty(len(keys), dtype=gram_dtype)
+    table["gram"] = keys
+    table["start"] = starts
+    table["count"] = counts
+    table.tofile(path + ".gram")
+    idxs.tofile(path + ".post")
 
-class GazMatcher:
+#
+#   Normalised names, so "st ives", "St Ives", "St. Ives" and "Saint Ives"
+#   are all found together. gaz.norm holds (key, idx) sorted by key.
 
-    def __init__(self, ftxt, name, itemsize, records):
-        self.ftxt = ftxt
-        self.itemsize = itemsize
-        self.records = records
-        self.last = None
-        self.name = name
+norm_punct = re.compile("['`]")
+norm_space = re.compile("[^a-z0-9\x80-\xff]+")
 
-    def match(self, idx, *record):
-        place = record[0]
-        #print idx, self.name, place
-        if re.match(self.name, place):
-            return 0
+fmt_norm = "=%dsI" % gaz_width
+norm_dtype = numpy.dtype([ ("key", "S%d" % gaz_width), ("idx", "=u4") ])
 
-        if self.name < place:
-            return 1
-        return -1
+def normalise(name):
+    name = norm_punct.sub("", name.lower())
+    words = norm_space.sub(" ", name).split()
+    return " ".join([ (w, "st")[w == "saint"] for w in words ])
 
-    def get(self, fidx, idx):
-        fidx.seek(self.itemsize * idx)
-        raw = fidx.read(self.itemsize)
-        county_idx, offset, length, osref = struct.unpack(idx_fmt, raw)
-        county = county_data[county_idx]
+def make_norm_db(path):
+    fidx = Table(path + ".idx", idx_fmt)
+    ftxt = MappedFile(path + ".txt")
 
-        self.ftxt.seek(offset)
-        placename = self.ftxt.read(length)
-        result = (placename, osref, county)
-        self.last = (idx,) + result
-        return result
+    print >> sys.stderr, "Making", path + ".norm"
+    table = numpy.empty(fidx.records, dtype=norm_dtype)
+    keys = []
+    for idx in range(fidx.records):
+        county_idx, offset, length, osref = fidx.get(idx)
+        keys.append(normalise(ftxt.data[offset:offset+length]))
+    fidx.close()
+    ftxt.close()
+
+    table["key"] = keys
+    table["idx"] = numpy.arange(len(keys))
+    table.sort(kind="mergesort", order="key")
+    table.tofile(path + ".norm")
+
+def search_gaz_norm(name, limit=None):
+    return get_db(gazdb=True).search_gaz_norm(name, limit)
 
 #
 #
 
-def search_gaz_re(fidx, matcher, name):
+def can_binary_search(match):
+    # return True if match has no regex in it, so is just a prefix
+    return not any((c in regex_special) for c in match)
 
-    data = []
-    # Iterate through the whole db
-    for idx in range(0, matcher.records):
-        record = matcher.get(fidx, idx)
-        if matcher.match(idx, *record) == 0:
-            data.append(record)
+#
+#
 
-    return data
+#   The literal text that any match of a regex must start with
 
-def search_gaz(name):
-    idx_path = get_name(gaz_name + ".idx")
-    txt_path = get_name(gaz_name + ".txt")
+regex_special = ".^$*+?{}[]\\|()"
 
-    itemsize = struct.calcsize(idx_fmt)
-    records = os.path.getsize(idx_path) / itemsize
+def regex_prefix(pattern):
+    if "|" in pattern:
+        return "" # alternatives can start with anything
+    if "(?" in pattern:
+        return "" # may set flags, eg. (?i), for the whole pattern
+    if pattern.startswith("^"):
+        pattern = pattern[1:]
 
-    fidx = open(idx_path, "rb")
-    ftxt = open(txt_path, "rb")
+    prefix = ""
+    for c in pattern:
+        if c in regex_special:
+            if c in "*?{":
+                # the last char may not be there at all
+                prefix = prefix[:-1]
+            break
+        prefix += c
+    return prefix
 
-    if not can_binary_search(name):
-        matcher = GazMatcher(ftxt, name, itemsize, records)
-        return search_gaz_re(fidx, matcher, name)
+def search_gaz(name, limit=None, county=None):
+    return get_db(gazdb=True).search_gaz(name, limit, county)
 
-    class Matcher(GazMatcher):
-        def match(self, idx, *record):
-            place = record[0]
-            #print idx, self.name, place
-            part = place[:len(self.name)]
-            if part == self.name:
-                return 0
-            if self.name < place:
-                return 1
-            return -1
+#
+#   In memory burst trie of the gaz names, for autocomplete.
+#   Prefixes of up to trie_depth chars map to the range of (sorted)
+#   places starting with them. Longer prefixes are found by searching
+#   within that range.
+
+trie_depth = 3
+
+class Completer:
+
+    def __init__(self, names, osrefs, cidxs, counties, nodes):
+        self.names = names
+        self.osrefs = osrefs
+        self.cidxs = cidxs
+        self.counties = counties
+        self.nodes = nodes
+
+    def bounds(self, prefix):
+        node = self.nodes.get(prefix[:trie_depth])
+        if node is None:
+            return 0, 0
+        start, end = node
+        if len(prefix) > trie_depth:
+            names, size = self.names, len(prefix)
+            def get_key(idx):
+                return names[idx][:size]
+            start = lower_bound(start, end, prefix, get_key)
+            end = upper_bound(start, end, prefix, get_key)
+        return start, end
+
+    def complete(self, prefix, limit=10):
+        start, end = self.bounds(prefix)
+        data = []
+        for idx in range(start, min(end, start + limit)):
+            county = self.counties[self.cidxs[idx]]
+            data.append((self.names[idx], self.osrefs[idx], county))
+        return data
+
+    def save(self, path):
+        f = open(path, "wb")
+        state = self.names, self.osrefs, self.cidxs, self.counties, self.nodes
+        marshal.dump(state, f)
+        f.close()
 
-    matcher = Matcher(ftxt, name, itemsize, records)
+    @staticmethod
+    def load(path):
+        f = open(path, "rb")
+        state = marshal.load(f)
+        f.close()
+        return Completer(*state)
+
+def make_complete_db(idx_path, txt_path, county_path, path):
+    fidx = Table(idx_path, idx_fmt)
+    ftxt = MappedFile(txt_path)
+    counties = open(county_path, "rb").read().split("\0")
+
+    print >> sys.stderr, "Making", path
+    names, osrefs, cidxs = [], [], []
+    nodes = { "" : (0, fidx.records) }
+    for idx in range(fidx.records):
+        county_idx, offset, length, osref = fidx.get(idx)
+        name = ftxt.data[offset:offset+length]
+        names.append(name)
+        osrefs.append(osref)
+        cidxs.append(county_idx)
+
+        for depth in range(1, trie_depth + 1):
+            key = name[:depth]
+            start, end = nodes.get(key, (idx, idx))
+            nodes[key] = (start, idx + 1)
+
+    fidx.close()
+    ftxt.close()
+    Completer(names, osrefs, cidxs, counties, nodes).save(path)
 
-    result = binary_search(fidx, 0, records, matcher.match, matcher.get)
-    # get result or nearest match
-    if not result:
-        return None
-        #result = matcher.last
-    idx, place, osref, county = result
+#
+#   Find the places whose name contains text, ignoring case
 
-    # search for any other places with the same name
-    idxs = search_adjacent(fidx, records, idx, matcher.match, matcher.get)
+def search_gaz_substring(text, limit=None):
+    return get_db(gazdb=True).search_gaz_substring(text, limit)
 
-    data = []
-    for idx in idxs:
-        record = matcher.get(fidx, idx)
-        data.append(record)
+#
+#   Deletion index for fuzzy gaz searches (as SymSpell).
+#   Every distinct name gets its lower case first fuzzy_prefix chars,
+#   with up to fuzzy_edits chars deleted, hashed into gaz.fuzzy.del
+#   as (hash, name no) sorted by hash. gaz.fuzzy.names holds the
+#   (first idx, count) run of gaz.idx records for each name no.
+#   A name within fuzzy_edits of a query shares a deletion with it.
+
+fuzzy_edits = 2
+fuzzy_prefix = 7
+
+fuzzy_dtype = numpy.dtype([ ("hash", "=u4"), ("name", "=u4") ])
+fuzzy_names_dtype = numpy.dtype([ ("start", "=u4"), ("count", "=u4") ])
+
+def deletions(word, edits):
+    found = set([ word ])
+    layer = found
+    for i in range(edits):
+        layer = set(w[:j] + w[j+1:] for w in layer for j in range(len(w)))
+        found |= layer
+    return found
 
-    return data
+def word_hash(word):
+    return zlib.crc32(word) & 0xffffffff
+
+def edit_distance(a, b, limit):
+    # Damerau (optimal string alignment) distance,
+    # or limit + 1 once it must be more than limit
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2 = None
+    prev = range(len(b) + 1)
+    for i in range(1, len(a) + 1):
+        row = [ i ] + [ 0 ] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i-1] == b[j-1] else 1
+            row[j] = min(prev[j] + 1, row[j-1] + 1, prev[j-1] + cost)
+            if i > 1 and j > 1 and a[i-1] == b[j-2] and a[i-2] == b[j-1]:
+                row[j] = min(row[j], prev2[j-2] + 1)
+        if min(row) > limit:
+            return limit + 1
+        prev2, prev = prev, row
+    return prev[-1]
+
+def make_fuzzy_db(idx_path, txt_path, del_path, names_path):
+    fidx = Table(idx_path, idx_fmt)
+    ftxt = MappedFile(txt_path)
+
+    print >> sys.stderr, "Making", del_path
+    hashes, numbers, runs = [], [], []
+    last = None
+    for idx in range(fidx.records):
+        county_idx, offset, length, osref = fidx.get(idx)
+        name = ftxt.data[offset:offset+length]
+        if name == last:
+            runs[-1][1] += 1
+            continue
+        last = name
+        number = len(runs)
+        runs.append([ idx, 1 ])
+        key = name.lower()[:fuzzy_prefix]
+        for word in deletions(key, fuzzy_edits):
+            hashes.append(word_hash(word))
+            numbers.append(number)
+    fidx.close()
+    ftxt.close()
+
+    data = numpy.empty(len(hashes), dtype=fuzzy_dtype)
+    data["hash"] = hashes
+    data["name"] = numbers
+    data.sort(order=("hash", "name"))
+    data.tofile(del_path)
+
+    names = numpy.array([ tuple(run) for run in runs ], dtype=fuzzy_names_dtype)
+    names.tofile(names_path)
 
 #
-#   find all the (adjacent) matching records 
+#   Places whose name is within max_edits of name, closest first
 
-def search_adjacent(fin, max_records, idx, matcher, get_record):
-    idxs = [ idx ]
-    # look backwards
-    for i in range(idx-1, -1, -1):
-        record = get_record(fin, i)
-        if matcher(0, *record) == 0:
-            idxs.append(i)
-        else:
-            break
-    # look forwards
-    for i in range(idx+1, max_records):
-        record = get_record(fin, i)
-        if matcher(0, *record) == 0:
-            idxs.append(i)
-        else:
-            break
+def search_gaz_fuzzy(name, max_edits=2):
+    return get_db(gazdb=True).search_gaz_fuzzy(name, max_edits)
+
+#
+#   Autocomplete : the first limit places starting with prefix
 
-    idxs.sort()
-    return idxs
+def complete(prefix, limit=10):
+    return get_db(gazdb=True).complete(prefix, limit)
 
 #
 #
 
 def search_os(match):
-    os_path = get_name(os_name)
-    itemsize = struct.calcsize(fmt_os)
-    records = os.path.getsize(os_path) / itemsize
-    fin = open(os_path, "rb")
-
-    def matcher(idx, *record):
-        osref, idxdb = record
-        if match == osref:
-            return 0;
-        if match < osref:
-            return 1
-        return -1
-    def get_record(fin, idx):
-        fin.seek(idx * itemsize)
-        blob = fin.read(itemsize)
-        return struct.unpack(fmt_os, blob)
-
-    # find any matching record
-    found, osref, idxb = binary_search(fin, 0, records, matcher, get_record)
-
-    idxs = search_adjacent(fin, records, found, matcher, get_record)
-    data = []
-    for i in idxs:
-        record = get_record(fin, i)
-        osref, idxdb = record
-        data.append(idxdb)
-
-    return data
+    return get_db(pcdb=True).search_os(match)
 
 #
 #   Create any database and index files
 
-county_data = None
-
 def make_all(pcdb, gazdb):
-    txt_path = get_name(txt_name)
+    if not os.path.exists(cache_base):
+        print >> sys.stderr, "mkdir", cache_base
+        try:
+            os.mkdir(cache_base)
+        except OSError:
+            pass # made by another process meanwhile
+
+    manifest = Manifest(get_name(manifest_name))
+    if not plan_steps(manifest, pcdb, gazdb) and not manifest.changed:
+        return
+
+    # other processes may be building the same files, into the same
+    # part files : take turns, then see what is still out of date.
+    # The manifest is only written while holding the lock.
+    lock = open(get_name(lock_name), "w")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        manifest.reload()
+        steps = plan_steps(manifest, pcdb, gazdb)
+        if steps:
+            run_steps(steps, build_jobs)
+        elif manifest.changed:
+            # new source signatures, with the same contents
+            manifest.save()
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+def plan_steps(manifest, pcdb, gazdb):
+    # the steps needed to bring the cache up to date
+    manifest.source("pc", pcpath)
+    manifest.source("gaz", gazpath)
+
     path = get_db_name()
+    steps = []
+
+    def add(step):
+        # build anything out of date, or whose inputs are being rebuilt
+        if not any(s.name in step.deps for s in steps):
+            if not manifest.stale(step.outputs, step.inputs):
+                return
+        for name in step.inputs:
+            manifest.check_source(name)
+        step.manifest = manifest
+        steps.append(step)
 
     if pcdb:
         # create the main db
-        if not os.path.exists(path):
-            make_db(txt_path, path)
-            # don't need the csv file any more ..
-            print >> sys.stderr, "Removing", txt_path 
-            os.remove(txt_path)
+        add(Step("db", make_db, (pcpath, part(path)), [ path ],
+                 inputs=["pc"]))
 
         lat_path = get_name(lat_name)
         lon_path = get_name(lon_name)
-        if not os.path.exists(lat_path):
-            make_idx_db(path, lat_path, lon_path)
-
         os_path = get_name(os_name)
-        if not os.path.exists(os_path):
-            make_os_db(path, os_path)
+        paths = [ lat_path, lon_path, os_path ]
+        # runs here, handing its sorts to the pool
+        args = [ path ] + [ part(p) for p in paths ]
+        add(Step("idx", make_idx_db, args, paths, inputs=[db_name],
+                 deps=["db"], local=True))
+
+        grids = [ get_name(grid_name), get_name(wgs_grid_name) ]
+        args = [ path ] + [ part(p) for p in grids ]
+        add(Step("grid", make_grid_db, args, grids, inputs=[db_name],
+                 deps=["db"]))
 
     if gazdb:
         gaz_path = get_name(gaz_name)
-        if not os.path.exists(gaz_path):
-            make_gaz_db(gaz_path)
+        county_path = get_name(county_name)
+        paths = [ gaz_path + ".idx", gaz_path + ".txt", county_path ]
+        grams = [ gaz_path + ".gram", gaz_path + ".post", gaz_path + ".norm",
+                  gaz_path + ".cidx", gaz_path + ".cstart", gaz_path + ".kind",
+                  gaz_path + ".en", gaz_path + ".grid" ]
+        add(Step("gaz", make_gaz_db, (part(gaz_path), part(county_path)),
+                 paths + grams, inputs=["gaz"]))
+
+        complete_path = get_name(complete_name)
+        add(Step("complete", make_complete_db, paths + [ part(complete_path) ],
+                 [ complete_path ], inputs=[ os.path.basename(p) for p in paths ],
+                 deps=["gaz"]))
+
+        fuzzy = get_name(fuzzy_name)
+        fuzzy_paths = [ fuzzy + ".del", fuzzy + ".names" ]
+        args = paths[:2] + [ part(p) for p in fuzzy_paths ]
+        add(Step("fuzzy", make_fuzzy_db, args, fuzzy_paths,
+                 inputs=[ os.path.basename(p) for p in paths[:2] ],
+                 deps=["gaz"]))
+
+    return steps
 
-        global county_data
-        f = open(get_name(county_name), "rb")
-        raw = f.read()
-        county_data = raw.split("\0")
+#
+#   Files are built under a temporary name, and renamed when complete
+
+def part(path):
+    root, ext = os.path.splitext(path)
+    return root + ".part" + ext
+
+def checksum(path):
+    h = hashlib.sha1()
+    f = open(path, "rb")
+    while True:
+        data = f.read(BLOCK)
+        if not data:
+            break
+        h.update(data)
+    f.close()
+    return h.hexdigest()
+
+#
+#   Manifest of the cache directory.
+#   Records the format version, the size, mtime and hash of each source
+#   file, and for each built file its size, hash and the hashes of the
+#   inputs it was built from. A file is only reused if all of these
+#   still match.
+#   Sources are checked by size and mtime, and only hashed if these
+#   change. A missing source is not checked, so a complete cache needs
+#   no sources. A source at a new path (pcpath, gazpath) is always
+#   checked.
+
+verify_cache = False # also hash the sources, and each built file
+
+class Manifest:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        data = None
+        if os.path.exists(path):
+            try:
+                data = json.load(open(path))
+            except ValueError:
+                data = None # a broken manifest : rebuild everything
+        if (not data) or (data.get("version") != format_version):
+            data = { "version" : format_version, "sources" : {}, "files" : {} }
+        self.data = data
+        self.paths = {}
+        self.checked = set()
+        self.changed = False # source signatures not yet saved
+
+    def reload(self):
+        # read it again, keeping the sources checked so far
+        checked = dict((name, self.data["sources"][name])
+                       for name in self.checked)
+        self.data = Manifest(self.path).data
+        self.changed = False
+        for name, sig in checked.items():
+            if self.data["sources"].get(name) != sig:
+                self.data["sources"][name] = sig
+                self.changed = True
+
+    def source(self, name, path):
+        self.paths[name] = path
+
+    def check_source(self, name):
+        # check the source file, only hashing it if it looks different
+        path = self.paths.get(name)
+        if (path is None) or (name in self.checked):
+            return # not a source, or done already
+        st = os.stat(path)
+        self.checked.add(name)
+        sig = self.data["sources"].get(name)
+        if sig and (sig["path"] == path) and (sig["size"] == st.st_size):
+            if (sig["mtime"] == st.st_mtime) and not verify_cache:
+                return
+        new = {
+            "path" : path,
+            "size" : st.st_size,
+            "mtime" : st.st_mtime,
+            "sha1" : checksum(path),
+        }
+        if new != sig:
+            # saved by the caller, holding the build lock
+            self.data["sources"][name] = new
+            self.changed = True
+
+    def inputs(self, names):
+        # current hashes of sources / built files
+        hashes = {}
+        for name in names:
+            entry = self.data["sources"].get(name)
+            if entry is None:
+                entry = self.data["files"].get(name)
+            hashes[name] = entry and entry["sha1"]
+        return hashes
+
+    def stale(self, paths, inputs):
+        for name in inputs:
+            if name not in self.paths:
+                continue
+            sig = self.data["sources"].get(name)
+            if (sig is None) or (sig["path"] != self.paths[name]):
+                return True
+            if os.path.exists(self.paths[name]):
+                self.check_source(name)
+        inputs = self.inputs(inputs)
+        for path in paths:
+            entry = self.data["files"].get(os.path.basename(path))
+            if entry is None:
+                return True
+            if not os.path.exists(path):
+                return True
+            if os.path.getsize(path) != entry["size"]:
+                return True
+            if entry["inputs"] != inputs:
+                return True
+            if verify_cache and (checksum(path) != entry["sha1"]):
+                return True
+        return False
+
+    def update(self, paths, inputs):
+        self.lock.acquire()
+        try:
+            inputs = self.inputs(inputs)
+            for path in paths:
+                self.data["files"][os.path.basename(path)] = {
+                    "size" : os.path.getsize(path),
+                    "sha1" : checksum(path),
+                    "inputs" : inputs,
+                }
+            self.save()
+        finally:
+            self.lock.release()
+
+    def save(self):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        f = os.fdopen(fd, "w")
+        json.dump(self.data, f, indent=1, sort_keys=True)
         f.close()
+        os.rename(tmp, self.path)
+
+#
+#   Build steps, run once the steps they depend on are done.
+#   Each step is driven by a thread, which waits for its dependencies
+#   then hands the work to a shared pool of worker processes. A local
+#   step runs in its thread instead, and is passed the pool.
+#   The step writes part() files, renamed to its outputs when done.
+
+build_jobs = None # default to the number of cpus
+
+class BuildError(Exception):
+    pass
+
+class Step:
+
+    def __init__(self, name, fn, args, outputs, inputs=[], deps=[],
+                 local=False):
+        self.name = name
+        self.fn = fn
+        self.args = tuple(args)
+        self.outputs = outputs
+        self.inputs = inputs
+        self.deps = deps
+        self.local = local
+        self.manifest = None
+        self.done = threading.Event()
+        self.error = None
+
+    def run(self, pool, steps):
+        try:
+            for name in self.deps:
+                dep = steps.get(name)
+                if dep is None:
+                    continue # already built
+                dep.done.wait()
+                if dep.error:
+                    raise BuildError("%s needs %s" % (self.name, name))
+
+            start = time.time()
+            if self.local:
+                self.fn(*self.args, pool=pool)
+            else:
+                pool.apply(self.fn, self.args)
+
+            for path in self.outputs:
+                os.rename(part(path), path)
+            if self.manifest:
+                self.manifest.update(self.outputs, self.inputs)
+
+            t = time.time() - start
+            print >> sys.stderr, "step %s took %.1fs" % (self.name, t)
+        except Exception, ex:
+            self.error = ex
+        self.done.set()
+
+def run_steps(steps, jobs=None):
+    pool = multiprocessing.Pool(jobs)
+    byname = dict((step.name, step) for step in steps)
+
+    threads = []
+    for step in steps:
+        thread = threading.Thread(target=step.run, args=(pool, byname))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    pool.close()
+    pool.join()
+
+    for step in steps:
+        if step.error:
+            raise step.error
 
 #
 # binary search on records
@@ -466,15 +1130,719 @@ def get_record(fin, idx):
     offset = idx * itemsize
     fin.seek(offset)
     blob = fin.read(itemsize)
-    pc, lat, lon, osref = struct.unpack(fmt, blob)
-    pc = pc[:7]
-    return pc, lat, lon, osref
+    record = struct.unpack(fmt, blob)
+    return (record[0][:7],) + record[1:]
 
 def num_records(path):
     itemsize = struct.calcsize(fmt)
     fsize = os.path.getsize(path)
     return fsize / itemsize
 
+#
+#   Memory mapped table of fixed size records.
+#   Records are decoded in place with a precompiled Struct,
+#   so a probe costs no seek, read or copy.
+
+class MappedFile:
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.fin = open(path, "rb")
+        if self.size:
+            self.data = mmap.mmap(self.fin.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # can't mmap an empty file
+            self.data = ""
+
+    def close(self):
+        if self.size:
+            self.data.close()
+        self.fin.close()
+
+class Table(MappedFile):
+
+    def __init__(self, path, fmt):
+        MappedFile.__init__(self, path)
+        self.struct = struct.Struct(fmt)
+        self.itemsize = self.struct.size
+        self.records = self.size / self.itemsize
+
+    def get(self, idx):
+        return self.struct.unpack_from(self.data, idx * self.itemsize)
+
+    def key(self, size):
+        # fn returning the first size bytes of a record
+        data, itemsize = self.data, self.itemsize
+        def get_key(idx):
+            offset = idx * itemsize
+            return data[offset:offset+size]
+        return get_key
+
+    def array(self, dtype, start, end):
+        # records [start, end) as a numpy array, without a copy
+        if start >= end:
+            return numpy.empty(0, dtype=dtype)
+        offset = start * self.itemsize
+        return numpy.frombuffer(self.data, dtype=dtype, count=end-start,
+                                offset=offset)
+
+#
+#   Mapped grid index, see make_grid_db()
+
+class Grid(MappedFile):
+
+    def __init__(self, path):
+        MappedFile.__init__(self, path)
+        header = struct.Struct(fmt_grid)
+        self.lat0, self.lon0, self.dlat, self.dlon, self.nrows, self.ncols = \
+                header.unpack_from(self.data)
+        ncells = self.nrows * self.ncols
+        offset = header.size
+        self.starts = numpy.frombuffer(self.data, dtype="=u4",
+                                       count=ncells+1, offset=offset)
+        offset += (ncells + 1) * 4
+        self.ids = numpy.frombuffer(self.data, dtype="=u4",
+                                    count=self.starts[-1], offset=offset)
+
+    def row(self, lat):
+        row = int((lat - self.lat0) / self.dlat)
+        return min(max(row, 0), self.nrows - 1)
+
+    def col(self, lon):
+        col = int((lon - self.lon0) / self.dlon)
+        return min(max(col, 0), self.ncols - 1)
+
+    def cells(self, lat_lo, lat_hi, lon_lo, lon_hi):
+        # the db idxs for all the cells covering the region
+        c0, c1 = self.col(lon_lo), self.col(lon_hi)
+        runs = []
+        for row in range(self.row(lat_lo), self.row(lat_hi) + 1):
+            cell = row * self.ncols
+            start, end = self.starts[cell + c0], self.starts[cell + c1 + 1]
+            runs.append(self.ids[start:end])
+        return numpy.concatenate(runs)
+
+    def ring(self, row, col, r):
+        # the db idxs for the cells exactly r cells away from (row, col)
+        c0, c1 = max(col - r, 0), min(col + r, self.ncols - 1)
+        starts = self.starts
+        runs = []
+        for y in sorted(set([ row - r, row + r ])):
+            if 0 <= y < self.nrows:
+                # top / bottom edge : the whole span of cells
+                cell = y * self.ncols
+                runs.append(self.ids[starts[cell + c0]:starts[cell + c1 + 1]])
+        if r:
+            # the sides, looking only at the cells that hold anything
+            ys = numpy.arange(max(row - r + 1, 0),
+                              min(row + r - 1, self.nrows - 1) + 1)
+            for x in (col - r, col + r):
+                if 0 <= x < self.ncols:
+                    cells = (ys * self.ncols) + x
+                    lo, hi = starts[cells], starts[cells + 1]
+                    full = lo < hi
+                    for start, end in zip(lo[full], hi[full]):
+                        runs.append(self.ids[start:end])
+        if not runs:
+            return self.ids[:0]
+        return numpy.concatenate(runs)
+
+    def covers(self, row, col, r):
+        # do the rings up to r cover the whole grid?
+        if (row - r) > 0 or (row + r) < (self.nrows - 1):
+            return False
+        return (col - r) <= 0 and (col + r) >= (self.ncols - 1)
+
+    def outside(self, lat, lon, row, col, r):
+        # lower bound, in metres, on the distance from (lat, lon) to
+        # any point in a cell not within the rings up to r. The point
+        # may lie off the grid, so measure to the cells left over : the
+        # rows above and below the rings, and the cells either side.
+        r0, r1 = max(row - r, 0), min(row + r, self.nrows - 1)
+        c0, c1 = max(col - r, 0), min(col + r, self.ncols - 1)
+        strips = []
+        if r0 > 0:
+            strips.append((0, r0 - 1, 0, self.ncols - 1))
+        if r1 < self.nrows - 1:
+            strips.append((r1 + 1, self.nrows - 1, 0, self.ncols - 1))
+        if c0 > 0:
+            strips.append((r0, r1, 0, c0 - 1))
+        if c1 < self.ncols - 1:
+            strips.append((r0, r1, c1 + 1, self.ncols - 1))
+        best = None
+        for y0, y1, x0, x1 in strips:
+            dy = gap(lat, self.lat0 + (y0 * self.dlat),
+                          self.lat0 + ((y1 + 1) * self.dlat))
+            dx = gap(lon, self.lon0 + (x0 * self.dlon),
+                          self.lon0 + ((x1 + 1) * self.dlon))
+            d = self.distance(dy, dx)
+            if (best is None) or (d < best):
+                best = d
+        return best
+
+    def distance(self, dlat, dlon):
+        # lower bound, in metres, for points dlat, dlon degrees apart
+        # a degree of longitude is shortest at the pole-most edge
+        top = max(abs(self.lat0), abs(self.lat0 + (self.nrows * self.dlat)))
+        metres = math.radians(1.0) * earths_radius
+        d = max(dlat * metres, dlon * metres * math.cos(math.radians(top)))
+        # allow for the small angle approximations
+        return d * 0.99
+
+#
+#   Grid of eastings (cols), northings (rows) in metres
+
+class PlaneGrid(Grid):
+
+    def distance(self, dn, de):
+        return math.hypot(dn, de)
+
+def gap(v, lo, hi):
+    # distance from v to the range [lo, hi]
+    return max(lo - v, v - hi, 0.0)
+
+#
+#   The k idxs in grid closest to (y, x), and their distances.
+#   measure(idxs) returns the idxs wanted, and their distances.
+
+def grid_nearest(grid, y, x, k, measure):
+    # search rings of cells outward from the one holding (y, x)
+    # until nothing further out can beat the k'th closest found
+    row, col = grid.row(y), grid.col(x)
+    idxs, dists = [], []
+    best = numpy.empty(0) # the k closest distances so far
+    r = 0
+    while True:
+        ring = grid.ring(row, col, r)
+        if len(ring):
+            ring, d = measure(ring)
+            idxs.append(ring)
+            dists.append(d)
+            best = numpy.concatenate((best, d))
+            if len(best) > k:
+                best = numpy.partition(best, k-1)[:k]
+        if grid.covers(row, col, r):
+            break
+        if len(best) >= k:
+            if best.max() <= grid.outside(y, x, row, col, r):
+                break
+        r += 1
+
+    if not idxs:
+        return [], []
+    idxs = numpy.concatenate(idxs)
+    dists = numpy.concatenate(dists)
+    order = numpy.lexsort((idxs, dists))[:k]
+    return idxs[order].astype(int).tolist(), dists[order].tolist()
+
+#
+#   Great circle distance in metres from a point to arrays of points
+
+def haversine(lat, lon, lats, lons):
+    lat, lon = math.radians(lat), math.radians(lon)
+    lats, lons = numpy.radians(lats), numpy.radians(lons)
+    a = numpy.sin((lats - lat) / 2) ** 2
+    a += math.cos(lat) * numpy.cos(lats) * (numpy.sin((lons - lon) / 2) ** 2)
+    return 2 * earths_radius * numpy.arcsin(numpy.sqrt(a))
+
+#
+#   Holds the postcode db and its indexes open for lookups
+
+class PostcodeStore:
+
+    def __init__(self):
+        self.tables = {}
+        self.open_pc()
+
+    def open_pc(self):
+        self.db = self.open(get_db_name(), fmt)
+        self.lat = self.open(get_name(lat_name), fmt_idx)
+        self.lon = self.open(get_name(lon_name), fmt_idx)
+        self.os = self.open(get_name(os_name), fmt_os)
+
+        # numpy view of the db, for bulk access
+        self.rows = numpy.frombuffer(self.db.data, dtype=db_dtype,
+                                     count=self.db.records)
+
+        path = get_name(grid_name)
+        self.grid = Grid(path)
+        self.tables[path] = self.grid
+        path = get_name(wgs_grid_name)
+        self.wgs_grid = Grid(path)
+        self.tables[path] = self.wgs_grid
+
+    def open(self, path, fmt):
+        table = self.tables.get(path)
+        if table is None:
+            table = Table(path, fmt)
+            self.tables[path] = table
+        return table
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+        self.tables = {}
+        self.db = self.lat = self.lon = self.os = None
+        self.rows = self.grid = self.wgs_grid = None
+
+    def get_record(self, table, idx):
+        record = table.get(idx)
+        return (record[0][:7],) + record[1:]
+
+    def search(self, match):
+        db = self.db
+        idx = lower_bound(0, db.records, match, self.get_pc)
+        if (idx == db.records) or (self.get_pc(idx) != match):
+            return None
+        return (idx,) + self.get_record(db, idx)
+
+    def search_many(self, postcodes):
+        # normalise, keeping any BadPostcode as that row's result
+        keys = []
+        for pc in postcodes:
+            if not isinstance(pc, basestring):
+                # eg. an empty or numeric cell from a csv file
+                keys.append(BadPostcode(pc))
+                continue
+            try:
+                # as a byte string, like the db, even if given unicode
+                keys.append(str(to7pc(pc)))
+            except BadPostcode, ex:
+                keys.append(ex)
+
+        db = self.db
+        get_pc = self.get_pc
+
+        # one forward pass over the db in postcode order
+        found = {}
+        idx = 0
+        for key in sorted(set(k for k in keys if not isinstance(k, BadPostcode))):
+            idx = gallop(idx, db.records, key, get_pc)
+            if idx == db.records:
+                break
+            if get_pc(idx) == key:
+                found[key] = (idx,) + self.get_record(db, idx)
+
+        results = []
+        for key in keys:
+            if isinstance(key, BadPostcode):
+                results.append(key)
+            else:
+                results.append(found.get(key))
+        return results
+
+    def get_pc(self, idx):
+        # the 7-char postcode of record idx
+        offset = idx * self.db.itemsize
+        return self.db.data[offset:offset+7]
+
+    def coord_bounds(self, table, lo, hi):
+        # range of index records with lo <= coord <= hi
+        def get_coord(idx):
+            return table.get(idx)[0]
+        start = lower_bound(0, table.records, lo, get_coord)
+        end = upper_bound(start, table.records, hi, get_coord)
+        return start, end
+
+    def prefix_bounds(self, prefix):
+        lo, hi = prefix_range(prefix)
+        start = lower_bound(0, self.db.records, lo, self.get_pc)
+        end = lower_bound(start, self.db.records, hi, self.get_pc)
+        return start, end
+
+    def search_prefix(self, prefix):
+        # bounds now, so a BadPostcode is raised here
+        start, end = self.prefix_bounds(prefix)
+        return ((idx,) + self.get_record(self.db, idx)
+                for idx in xrange(start, end))
+
+    def count_prefix(self, prefix):
+        start, end = self.prefix_bounds(prefix)
+        return end - start
+
+    def find_coord(self, path, coord):
+        table = self.open(path, fmt_idx)
+        if not table.records:
+            return None
+        start, end = self.coord_bounds(table, coord, coord)
+        # return the nearest item, even if no match was found
+        idx = min(start, table.records - 1)
+        return (idx,) + table.get(idx)
+
+    def between(self, path, lo, hi):
+        table = self.open(path, fmt_idx)
+        start, end = self.coord_bounds(table, lo, hi)
+        data = table.array(idx_dtype, start, end)
+        return data["idx"].astype(int).tolist()
+
+    def get_range(self, lat_lo, lat_hi, lon_lo, lon_hi):
+        if (lat_lo > lat_hi) or (lon_lo > lon_hi):
+            return set()
+        # candidates from the grid, then check the edge cells
+        idxs = self.grid.cells(lat_lo, lat_hi, lon_lo, lon_hi)
+        rows = self.rows[idxs]
+        lats, lons = rows["lat"], rows["lon"]
+        found = (lats >= lat_lo) & (lats <= lat_hi)
+        found &= (lons >= lon_lo) & (lons <= lon_hi)
+        return set(idxs[found].astype(int).tolist())
+
+    def nearest(self, lat, lon, k=1):
+        # lat, lon are WGS84, as from GPS
+        grid = self.wgs_grid
+        k = min(k, self.db.records)
+        if k < 1:
+            return []
+
+        def measure(ring):
+            rows = self.rows[ring]
+            return ring, haversine(lat, lon, rows["wgs_lat"], rows["wgs_lon"])
+
+        idxs, dists = grid_nearest(grid, lat, lon, k, measure)
+        data = []
+        for idx, dist in zip(idxs, dists):
+            record = (idx,) + self.get_record(self.db, idx)
+            data.append((dist, record))
+        return data
+
+    def search_os(self, match):
+        table = self.os
+        get_key = table.key(8)
+        start = lower_bound(0, table.records, match, get_key)
+        end = upper_bound(start, table.records, match, get_key)
+        data = table.array(os_dtype, start, end)
+        return data["idx"].astype(int).tolist()
+
+#
+#   Handle on the postcode db, the gazetteer and their indexes.
+#   init() builds anything missing, then opens it all once.
+
+class PostcodeDB(PostcodeStore):
+
+    def __init__(self):
+        self.tables = {}
+        self.db = self.lat = self.lon = self.os = None
+        self.rows = self.grid = self.wgs_grid = None
+        self.gaz_idx = None
+        self.gaz_txt = None
+        self.counties = None
+        self.county_idx = self.gaz_cidx = self.gaz_cstart = None
+        self.gaz_grid = self.gaz_en = self.gaz_kind = None
+        self.gaz_grams = self.gaz_post = self.gaz_norm = None
+        self.fuzzy = self.fuzzy_names = None
+        self.completer = None
+
+    def init(self, pcdb=True, gazdb=True, complete=False):
+        make_all(pcdb, gazdb)
+        if pcdb and (self.db is None):
+            self.open_pc()
+        if gazdb and (self.gaz_idx is None):
+            self.open_gaz()
+        if complete and gazdb:
+            self.load_completer()
+
+    def load_completer(self):
+        if self.completer is None:
+            self.completer = Completer.load(get_name(complete_name))
+        return self.completer
+
+    def complete(self, prefix, limit=10):
+        return self.load_completer().complete(prefix, limit)
+
+    def open_gaz(self):
+        self.gaz_idx = self.open(get_name(gaz_name + ".idx"), idx_fmt)
+        self.gaz_txt = MappedFile(get_name(gaz_name + ".txt"))
+
+        f = open(get_name(county_name), "rb")
+        raw = f.read()
+        self.counties = raw.split("\0")
+        f.close()
+        self.county_idx = dict((c, i) for i, c in enumerate(self.counties))
+
+        table = self.open(get_name(gaz_name + ".cidx"), "=I")
+        self.gaz_cidx = table.array(numpy.uint32, 0, table.records)
+        table = self.open(get_name(gaz_name + ".cstart"), "=I")
+        self.gaz_cstart = table.array(numpy.uint32, 0, table.records)
+
+        table = self.open(get_name(gaz_name + ".gram"), fmt_gram)
+        self.gaz_grams = table.array(gram_dtype, 0, table.records)
+        table = self.open(get_name(gaz_name + ".post"), "=I")
+        self.gaz_post = table.array(numpy.uint32, 0, table.records)
+
+        path = get_name(gaz_name + ".grid")
+        self.gaz_grid = PlaneGrid(path)
+        self.tables[path] = self.gaz_grid
+        table = self.open(get_name(gaz_name + ".en"), "=ii")
+        self.gaz_en = table.array(en_dtype, 0, table.records)
+        table = self.open(get_name(gaz_name + ".kind"), "=%ds" % kind_width)
+        self.gaz_kind = table.array("S%d" % kind_width, 0, table.records)
+
+        table = self.open(get_name(gaz_name + ".norm"), fmt_norm)
+        self.gaz_norm = table.array(norm_dtype, 0, table.records)
+
+        path = get_name(fuzzy_name)
+        table = self.open(path + ".del", "=II")
+        self.fuzzy = table.array(fuzzy_dtype, 0, table.records)
+        table = self.open(path + ".names", "=II")
+        self.fuzzy_names = table.array(fuzzy_names_dtype, 0, table.records)
+
+    def close(self):
+        PostcodeStore.close(self)
+        if self.gaz_txt:
+            self.gaz_txt.close()
+        self.gaz_idx = self.gaz_txt = self.counties = None
+        self.county_idx = self.gaz_cidx = self.gaz_cstart = None
+        self.gaz_grid = self.gaz_en = self.gaz_kind = None
+        self.gaz_grams = self.gaz_post = self.gaz_norm = None
+        self.fuzzy = self.fuzzy_names = None
+        self.completer = None
+
+    def search_gaz(self, name, limit=None, county=None):
+        if not can_binary_search(name):
+            return self.search_gaz_re(name, limit, county)
+
+        # find the range of places starting with name
+        idxs = self.gaz_county(county)
+        start, end = self.gaz_bounds(name, idxs)
+        if start == end:
+            return None
+        if limit:
+            end = min(end, start + limit)
+
+        data = []
+        for idx in self.gaz_range(idxs, start, end):
+            data.append(self.gaz_record(idx))
+
+        return data
+
+    def search_gaz_re(self, name, limit=None, county=None):
+        fidx, text = self.gaz_idx, self.gaz_txt.data
+        regex = re.compile(name)
+
+        # only places starting with the regex's literal prefix can match
+        idxs = self.gaz_county(county)
+        prefix = regex_prefix(name)
+        if prefix:
+            start, end = self.gaz_bounds(prefix, idxs)
+        elif idxs is None:
+            start, end = 0, fidx.records
+        else:
+            start, end = 0, len(idxs)
+
+        data = []
+        for idx in self.gaz_range(idxs, start, end):
+            county_idx, offset, length, osref = fidx.get(idx)
+            place = text[offset:offset+length]
+            if regex.match(place):
+                data.append((place, osref, self.counties[county_idx]))
+                if limit and (len(data) >= limit):
+                    break
+
+        return data
+
+    def places_in_county(self, county):
+        fidx, text = self.gaz_idx, self.gaz_txt.data
+        idxs = self.gaz_county(county)
+        for idx in self.gaz_range(idxs, 0, len(idxs)):
+            county_idx, offset, length, osref = fidx.get(idx)
+            yield (text[offset:offset+length], osref, county)
+
+    def search_gaz_substring(self, text, limit=None):
+        fidx, data = self.gaz_idx, self.gaz_txt.data
+        text = text.lower()
+
+        grams = trigrams(text)
+        if grams:
+            # only names holding every trigram can match
+            keys = self.gaz_grams["gram"]
+            found = None
+            for gram in grams:
+                i = numpy.searchsorted(keys, gram)
+                if (i == len(keys)) or (keys[i] != gram):
+                    return []
+                start, count = self.gaz_grams[i]["start"], self.gaz_grams[i]["count"]
+                idxs = self.gaz_post[start:start+count]
+                if found is None:
+                    found = idxs
+                else:
+                    found = numpy.intersect1d(found, idxs, assume_unique=True)
+            idxs = found.tolist()
+        else:
+            # too short to use the index
+            idxs = xrange(fidx.records)
+
+        places = []
+        for idx in idxs:
+            county_idx, offset, length, osref = fidx.get(idx)
+            place = data[offset:offset+length]
+            if text in place.lower():
+                places.append((place, osref, self.counties[county_idx]))
+                if limit and (len(places) >= limit):
+                    break
+        return places
+
+    def nearest_place(self, lat, lon, k=1, kinds=None):
+        # kinds : the feature codes wanted, eg. [ "C", "T" ]
+        if isinstance(kinds, basestring):
+            kinds = [ kinds ]
+        fidx, text = self.gaz_idx, self.gaz_txt.data
+        e, n = wgs84_to_en(lat, lon)
+        if k < 1:
+            return []
+
+        def measure(ring):
+            if kinds:
+                ring = ring[numpy.in1d(self.gaz_kind[ring], kinds)]
+            en = self.gaz_en[ring]
+            return ring, numpy.hypot(en["e"] - e, en["n"] - n)
+
+        idxs, dists = grid_nearest(self.gaz_grid, n, e, k, measure)
+        data = []
+        for idx, dist in zip(idxs, dists):
+            county_idx, offset, length, osref = fidx.get(idx)
+            place = text[offset:offset+length]
+            data.append((dist, (place, osref, self.counties[county_idx])))
+        return data
+
+    def search_gaz_norm(self, name, limit=None):
+        name = normalise(name)
+        keys, size = self.gaz_norm["key"], len(name)
+
+        def get_key(idx):
+            return keys[idx][:size]
+
+        # find the range of normalised names starting with name
+        start = lower_bound(0, len(keys), name, get_key)
+        end = upper_bound(start, len(keys), name, get_key)
+        if start == end:
+            return None
+        if limit:
+            end = min(end, start + limit)
+
+        data = []
+        for idx in self.gaz_norm["idx"][start:end].tolist():
+            data.append(self.gaz_record(idx))
+        return data
+
+    def search_gaz_fuzzy(self, name, max_edits=2):
+        # the index can't find anything further away
+        max_edits = min(max_edits, fuzzy_edits)
+        fidx, text = self.gaz_idx, self.gaz_txt.data
+        name = name.lower()
+
+        # names sharing a deletion with the query
+        hashes = self.fuzzy["hash"]
+        numbers = set()
+        for word in deletions(name[:fuzzy_prefix], max_edits):
+            h = word_hash(word)
+            start = numpy.searchsorted(hashes, h, "left")
+            end = numpy.searchsorted(hashes, h, "right")
+            numbers.update(self.fuzzy["name"][start:end].tolist())
+
+        found = []
+        for number in numbers:
+            start, count = self.fuzzy_names[number]
+            county_idx, offset, length, osref = fidx.get(start)
+            place = text[offset:offset+length]
+            d = edit_distance(name, place.lower(), max_edits)
+            if d <= max_edits:
+                found.append((d, start, count))
+        found.sort()
+
+        data = []
+        for d, start, count in found:
+            for idx in range(start, start + count):
+                county_idx, offset, length, osref = fidx.get(idx)
+                place = text[offset:offset+length]
+                data.append((place, osref, self.counties[county_idx]))
+        return data
+
+    def gaz_county(self, county):
+        # the idxs of the places in county, in name order,
+        # or None for every place
+        if county is None:
+            return None
+        c = self.county_idx.get(county)
+        if c is None:
+            return self.gaz_cidx[:0]
+        start, end = self.gaz_cstart[c:c+2].tolist()
+        return self.gaz_cidx[start:end]
+
+    def gaz_record(self, idx):
+        # (placename, osref, county) of gaz record idx
+        county_idx, offset, length, osref = self.gaz_idx.get(idx)
+        placename = self.gaz_txt.data[offset:offset+length]
+        return placename, osref, self.counties[county_idx]
+
+    def gaz_range(self, idxs, start, end):
+        if idxs is None:
+            return xrange(start, end)
+        return idxs[start:end].tolist()
+
+    def gaz_bounds(self, name, idxs=None):
+        fidx, text = self.gaz_idx, self.gaz_txt.data
+        size = len(name)
+
+        if idxs is None:
+            records = fidx.records
+            def get_key(idx):
+                county_idx, offset, length, osref = fidx.get(idx)
+                return text[offset:offset+min(length, size)]
+        else:
+            records = len(idxs)
+            def get_key(i):
+                county_idx, offset, length, osref = fidx.get(int(idxs[i]))
+                return text[offset:offset+min(length, size)]
+
+        start = lower_bound(0, records, name, get_key)
+        end = upper_bound(start, records, name, get_key)
+        return start, end
+
+#
+#   The db used by the module level functions
+
+default_db = None
+
+def get_db(pcdb=False, gazdb=False):
+    global default_db
+    if default_db is None:
+        default_db = PostcodeDB()
+    # open (building if need be) any part not yet loaded
+    pcdb = pcdb and (default_db.db is None)
+    gazdb = gazdb and (default_db.gaz_idx is None)
+    if pcdb or gazdb:
+        default_db.init(pcdb, gazdb)
+    return default_db
+
+#
+#   numpy record types matching fmt, fmt_idx and fmt_os
+
+# the db record columns from the source, and as stored
+db_src_dtype = numpy.dtype([
+    ("pc", "S8"), ("lat", "=f8"), ("lon", "=f8"), ("osref", "S8")
+])
+db_dtype = numpy.dtype(db_src_dtype.descr + [
+    ("east", "=i4"), ("north", "=i4"), ("wgs_lat", "=f8"), ("wgs_lon", "=f8")
+])
+idx_dtype = numpy.dtype([ ("coord", "=f8"), ("idx", "=u4") ])
+os_dtype = numpy.dtype([ ("osref", "S8"), ("idx", "=u4") ])
+
+assert db_dtype.itemsize == struct.calcsize(fmt)
+assert idx_dtype.itemsize == struct.calcsize(fmt_idx)
+assert os_dtype.itemsize == struct.calcsize(fmt_os)
+
+#
+#   Read the db in chunks, as numpy arrays of db_dtype
+
+def visit_batches(path, chunk_rows=65536):
+    fin = open(path, "rb")
+    while True:
+        batch = numpy.fromfile(fin, dtype=db_dtype, count=chunk_rows)
+        if not len(batch):
+            break
+        yield batch
+    fin.close()
+
 #
 #   Generic visitor function
 
@@ -486,122 +1854,110 @@ def visit(path, callback, num_records=num_records, get_record=get_record):
         callback(idx, *record)
 
 #
-#
-
-def binary_search(fin, start, end, match_fn, get_record_fn):
-    if start == end:
-        return None
-
-    idx = (start + end) / 2
-    record = get_record_fn(fin, idx)
+#   Exponential search forward from start for the first key >= match.
+#   Cheap when the next match is close, O(log distance) when it isn't.
+
+def gallop(start, end, match, get_key):
+    if (start == end) or (get_key(start) >= match):
+        return start
+
+    # get_key(lo) < match, find hi with get_key(hi) >= match
+    lo, step = start, 1
+    hi = lo + step
+    while (hi < end) and (get_key(hi) < match):
+        lo = hi
+        step += step
+        hi = lo + step
+    hi = min(hi, end)
+
+    # binary search in (lo, hi]
+    lo += 1
+    while lo < hi:
+        idx = (lo + hi) / 2
+        if get_key(idx) < match:
+            lo = idx + 1
+        else:
+            hi = idx
+    return lo
 
-    compare = match_fn(idx, *record)
-    if compare == 0:
-        return (idx,) + record
-    if compare < 0:
-        return binary_search(fin, idx+1, end, match_fn, get_record_fn)
-    else:
-        return binary_search(fin, start, idx, match_fn, get_record_fn)
+#
+#   First idx in [start, end) whose key is >= match (lower_bound),
+#   or > match (upper_bound). end if there isn't one.
+
+def lower_bound(start, end, match, get_key):
+    while start < end:
+        idx = (start + end) / 2
+        if get_key(idx) < match:
+            start = idx + 1
+        else:
+            end = idx
+    return start
+
+def upper_bound(start, end, match, get_key):
+    while start < end:
+        idx = (start + end) / 2
+        if get_key(idx) <= match:
+            start = idx + 1
+        else:
+            end = idx
+    return start
 
 #
 #
 
 def find_coord(path, coord):
-    itemsize = struct.calcsize(fmt_idx)
-    fsize = os.path.getsize(path)
-    records = fsize / itemsize
-
-    class CoordMatcher:
-        def __init__(self):
-            self.last = None
-        def match(self, idx, co, data):
-            self.last = idx, co, data
-            if co == coord:
-                return 0
-            if co < coord:
-                return -1
-            return 1;
-
-    matcher = CoordMatcher()
-    fin = open(path, "r")
-    binary_search(fin, 0, records, matcher.match, get_record_idx)
-    fin.close()
-    # return the last item checked, even if no match was found
-    return matcher.last
+    return get_db(pcdb=True).find_coord(path, coord)
 
 #
 #   Return the idx into the db for a range of lon / lat values
 
 def between(path, lo, hi):
-    slo = find_coord(path, lo)[0]
-    shi = find_coord(path, hi)[0]
-
-    idxs = []
-    fin = open(path, "r")
-    for idx in range(slo, shi+1):
-        coord, db = get_record_idx(fin, idx)
-        idxs.append(db)
-    fin.close()
-    return idxs
+    return get_db(pcdb=True).between(path, lo, hi)
 
 #
 #
 
 def search(match):
-    path = get_db_name()
+    return get_db(pcdb=True).search(match)
+
+#
+#   Look up many postcodes at once.
+#   Returns a result per postcode, in order : the search() record,
+#   None if not found, or the BadPostcode exception if it won't parse.
 
-    def match_fn(idx, pc, lat, lon, osref):
-        if pc == match:
-            return 0;
-        if pc < match:
-            return -1
-        return 1
+def search_many(postcodes):
+    return get_db(pcdb=True).search_many(postcodes)
 
-    records = num_records(path)
-    fin = open(path, "r")
-    found = binary_search(fin, 0, records, match_fn, get_record)
-    fin.close()
-    return found
+#
+#   All the records for a postcode area ("SW"), district ("BS8"),
+#   sector ("BS8 1") or any longer prefix, in postcode order.
+
+def search_prefix(prefix):
+    return get_db(pcdb=True).search_prefix(prefix)
+
+def count_prefix(prefix):
+    return get_db(pcdb=True).count_prefix(prefix)
 
 #
 #   Get the db indexes for a bounded region
 
 def get_range(lat_lo, lat_hi, lon_lo, lon_hi):
-    lat_path = get_name(lat_name)
-    lon_path = get_name(lon_name)
-    lats = between(lat_path, lat_lo, lat_hi)
-    lons = between(lon_path, lon_lo, lon_hi)
-
-    lons = set(lons)
-    lats = set(lats)
-    idxs = lons.intersection(lats)
-
-    return idxs
+    return get_db(pcdb=True).get_range(lat_lo, lat_hi, lon_lo, lon_hi)
 
 #
 #
 
 def get_nearest(lat, lon, margin=None, find=None):
+    # margin is no longer used : the search grows as far as it needs to
+    found = nearest(lat, lon, find or 1)
+    return [ record[0] for dist, record in found ]
 
-    # search a square for extant postcodes
-    if margin is None:
-        marg = 0.0002
-    else:
-        marg = margin
-
-    while True:
-        #print "search", margin
-        idxs = get_range(lat-marg, lat+marg, lon-marg, lon+marg)
-        if find:
-            if len(idxs) >= find:
-                return idxs
-        else:
-            if idxs:
-                break
-        # none found, so increase the search area
-        marg += marg
+#
+#   Return the k nearest records to WGS84 lat, lon, closest first,
+#   as a list of (distance in metres, search() record).
 
-    return idxs
+def nearest(lat, lon, k=1):
+    return get_db(pcdb=True).nearest(lat, lon, k)
 
 #
 #   use for eg. http://www.openstreetmap.org/#map=14/51.0640/-1.7820
@@ -638,6 +1994,36 @@ def to7pc(pc):
     assert len(pc) == 7
     return pc
 
+#
+#   Convert a postcode prefix into the range [lo, hi) of 7-char keys
+
+re_prefix = re.compile("([A-Z][A-Z]?)((?:\d\d?|\d[A-Z])?)(?: +(\d[A-Z]?[A-Z]?))?$")
+
+def prefix_range(prefix):
+    try:
+        pc = str(to7pc(prefix))
+        return pc, pc + "\xff"
+    except BadPostcode:
+        pass
+
+    match = re_prefix.match(prefix.upper().strip())
+    if not match:
+        raise BadPostcode(prefix)
+    # the pattern is ascii, so unicode input converts
+    area, district, inward = map(str, match.groups(""))
+    if not district:
+        if inward:
+            raise BadPostcode(prefix)
+        # the area followed by any digit
+        return area + "0", area + ":"
+
+    key = area + district
+    # pad the district with spaces
+    key += ' ' * (4 - len(key))
+    if inward:
+        key += inward
+    return key, key + "\xff"
+
 #
 #   Convert OS 4-figure to 6-figure
 
@@ -647,8 +2033,11 @@ def os4to6(osref):
 #
 #
 
-def init(pcdb=True, gazdb=True):
-    make_all(pcdb, gazdb)
+def init(pcdb=True, gazdb=True, complete=False):
+    db = get_db(pcdb, gazdb)
+    if complete and gazdb:
+        db.load_completer()
+    return db
 
 #
 #
@@ -657,14 +2046,27 @@ if __name__ == "__main__":
 
     p = optparse.OptionParser()
     p.add_option("-g", "--gaz", dest="gaz")
+    p.add_option("-c", "--county", dest="county")
     p.add_option("-p", "--postcode", dest="postcode")
     p.add_option("-l", "--location", dest="location")
     p.add_option("-o", "--osref", dest="osref")
+    p.add_option("-x", "--prefix", dest="prefix")
     p.add_option("-m", "--margin", dest="margin", type="float")
     p.add_option("-f", "--find", dest="find", type="int")
+    p.add_option("--sort-mb", dest="sort_mb", type="int")
+    p.add_option("-j", "--jobs", dest="jobs", type="int")
+    p.add_option("--verify", dest="verify", action="store_true")
 
     opts, args = p.parse_args()
 
+    if opts.jobs:
+        build_jobs = opts.jobs
+    if opts.verify:
+        verify_cache = True
+
+    if opts.sort_mb:
+        sort_budget = opts.sort_mb * 1024 * 1024
+
     init()
 
     path = get_db_name()
@@ -678,7 +2080,7 @@ if __name__ == "__main__":
 
     if opts.gaz:
         print "find gaz", opts.gaz
-        places = search_gaz(opts.gaz)
+        places = search_gaz(opts.gaz, county=opts.county)
 
         if places:
             for place, osref4, county in places:
@@ -702,14 +2104,19 @@ if __name__ == "__main__":
 
     if is_lat_lon:
         print "get nearest", lat, lon
-        idxs = get_nearest(lat, lon, margin=opts.margin, find=opts.find)
-        print idxs
-        show(idxs)
+        for dist, record in nearest(lat, lon, opts.find or 1):
+            print "%.0fm" % dist, record
+
+    if opts.prefix:
+        print count_prefix(opts.prefix), "postcodes in", opts.prefix
+        for record in search_prefix(opts.prefix):
+            print record
 
     if opts.postcode:
-        _, pc, lat, lon, osref = search(to7pc(pc))
-        print open_street_map(lat, lon)
-        print osref
+        record = search(to7pc(pc))
+        lat, lon, osref, east, north, wgs_lat, wgs_lon = record[2:]
+        print open_street_map(wgs_lat, wgs_lon)
+        print osref, east, north
 
         if opts.margin:
             margin = opts.margin